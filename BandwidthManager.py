@@ -0,0 +1,209 @@
+# coding=utf-8
+import os
+import signal
+import threading
+import time
+
+
+TOTAL_DOWNLOAD_RATE = 2000  # KiB/s
+FOREGROUND_SHARE = 0.8
+THROTTLE_INTERVAL = 0.25
+BURST_DURATION = 1.0
+
+
+class RateLimiter(object):
+    """
+    The share of the bandwidth given to one download. Its rate is changed by the manager
+    while the download runs. In-process downloads call consume() for every block they read;
+    download processes are attached and paused by the manager when they get ahead of their rate.
+    @param manager: the BandwidthManager
+    @param is_foreground: true for the video being watched, false for a prefetch
+    """
+
+    def __init__(self, manager, is_foreground):
+        self.manager = manager
+        self.is_foreground = is_foreground
+        self.rate = 0  # bytes per second
+
+        self.lock = threading.Lock()
+        self.allowance = 0
+        self.last_refill = time.time()
+
+        self.process = None
+        self.progress = None
+        self.is_process_stopped = False
+
+    def get_rate(self):
+        return self.rate
+
+    def set_foreground(self, is_foreground):
+        if self.is_foreground != is_foreground:
+            self.is_foreground = is_foreground
+            self.manager.rebalance()
+
+    def attach_process(self, process, progress):
+        """
+        Lets the manager throttle a download process, using the DownloadProgress of the download
+        to know how fast it is going.
+        """
+        with self.lock:
+            self.process = process
+            self.progress = progress
+            self.allowance = progress.get_downloaded_bytes() + self.get_burst_size()
+            self.last_refill = time.time()
+        self.manager.wake_up_throttle()
+
+    def consume(self, number_of_bytes):
+        """
+        Waits until the download is allowed to read number_of_bytes more bytes.
+        """
+        while True:
+            with self.lock:
+                self.refill()
+                if self.allowance >= number_of_bytes:
+                    self.allowance -= number_of_bytes
+                    return
+                missing_bytes = number_of_bytes - self.allowance
+                rate = self.rate
+
+            time.sleep(min(BURST_DURATION, missing_bytes / float(max(rate, 1))))
+
+    def refill(self):
+        now = time.time()
+        self.allowance += self.rate * (now - self.last_refill)
+        self.last_refill = now
+
+    def get_burst_size(self):
+        return self.rate * BURST_DURATION
+
+    def throttle(self):
+        """
+        Pauses the attached process if it has downloaded more than its allowance, resumes it otherwise.
+        """
+        with self.lock:
+            if not self.process or self.process.poll() is not None:
+                return
+
+            downloaded_bytes = self.progress.get_downloaded_bytes()
+            self.refill()
+            # The allowance does not accumulate while the download is slower than its rate
+            self.allowance = min(self.allowance, downloaded_bytes + self.get_burst_size())
+            must_stop = downloaded_bytes >= self.allowance
+
+            if must_stop != self.is_process_stopped:
+                self.send_signal(signal.SIGSTOP if must_stop else signal.SIGCONT)
+                self.is_process_stopped = must_stop
+
+    def send_signal(self, signal_number):
+        try:
+            # The whole process group: youtube-dl and the processes it started
+            os.killpg(self.process.pid, signal_number)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Gives the bandwidth back to the other downloads. A paused process is resumed, so that it can end.
+        """
+        with self.lock:
+            if self.is_process_stopped:
+                self.send_signal(signal.SIGCONT)
+                self.is_process_stopped = False
+            self.process = None
+            self.progress = None
+        self.manager.remove(self)
+
+
+class BandwidthManager(object):
+    """
+    Shares a total download rate between all the downloads. The foreground video (the one
+    being watched) gets most of it, the prefetches share the rest. When a download ends,
+    is skipped or changes role, the rates of the running downloads are recomputed.
+    @param total_rate: the total download rate, in KiB/s
+    """
+
+    def __init__(self, total_rate=TOTAL_DOWNLOAD_RATE):
+        self.total_rate = total_rate
+        self.limiters = []
+        self.condition = threading.Condition()
+        self.throttle_thread = None
+
+    def get_total_rate(self):
+        return self.total_rate
+
+    def set_total_rate(self, total_rate):
+        self.total_rate = total_rate
+        self.rebalance()
+
+    def open_stream(self, is_foreground):
+        """
+        Registers a new download and returns its RateLimiter.
+        @param is_foreground: true for the video being watched, false for a prefetch
+        """
+        limiter = RateLimiter(self, is_foreground)
+        with self.condition:
+            self.limiters.append(limiter)
+        self.rebalance()
+        return limiter
+
+    def remove(self, limiter):
+        with self.condition:
+            if limiter in self.limiters:
+                self.limiters.remove(limiter)
+        self.rebalance()
+
+    def rebalance(self):
+        with self.condition:
+            foreground = [limiter for limiter in self.limiters if limiter.is_foreground]
+            prefetches = [limiter for limiter in self.limiters if not limiter.is_foreground]
+
+            total_rate = self.total_rate * 1024
+            if foreground and prefetches:
+                foreground_rate = total_rate * FOREGROUND_SHARE
+            elif foreground:
+                foreground_rate = total_rate
+            else:
+                foreground_rate = 0
+
+            for limiter in foreground:
+                limiter.rate = foreground_rate / len(foreground)
+            for limiter in prefetches:
+                limiter.rate = (total_rate - foreground_rate) / len(prefetches)
+
+    def wake_up_throttle(self):
+        with self.condition:
+            if self.throttle_thread is None:
+                self.throttle_thread = threading.Thread(target=self.throttle_processes, name="bandwidth-throttle")
+                self.throttle_thread.daemon = True
+                self.throttle_thread.start()
+            self.condition.notify()
+
+    def throttle_processes(self):
+        while True:
+            with self.condition:
+                while not self.has_attached_processes():
+                    self.condition.wait()
+                limiters = list(self.limiters)
+
+            for limiter in limiters:
+                limiter.throttle()
+
+            time.sleep(THROTTLE_INTERVAL)
+
+    def has_attached_processes(self):
+        return any(limiter.process for limiter in self.limiters)
+
+
+shared_manager = None
+shared_manager_lock = threading.Lock()
+
+
+def get_shared_bandwidth_manager():
+    """
+    Returns the bandwidth manager shared by all the downloads of the application.
+    """
+    global shared_manager
+    with shared_manager_lock:
+        if shared_manager is None:
+            shared_manager = BandwidthManager()
+        return shared_manager
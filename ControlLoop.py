@@ -0,0 +1,55 @@
+# coding=utf-8
+import threading
+from Queue import Queue
+
+
+class ControlLoop(object):
+    """
+    A single thread that runs the actions of the user (search, next, previous) and the steps
+    that follow them, one at a time and in order. The UI thread only submits them, so it never
+    waits for the network or a download. The steps must not block either: what takes time
+    (fetching a page, downloading) runs on the download threads, which submit the next step
+    back to the loop when they are done.
+    @param name: the name of the thread
+    """
+
+    def __init__(self, name="control-loop"):
+        self.name = name
+        self.queue = Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """
+        Runs the function on the control thread, after the steps already submitted.
+        Can be called from any thread.
+        """
+        self.start()
+        self.queue.put((function, args))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            (function, args) = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                # A failed step must not stop the steps of the following actions
+                print("Control step %s failed: %s" % (getattr(function, '__name__', function), e))
+
+
+control_loop = ControlLoop()
+
+
+def get_control_loop():
+    """
+    Returns the control loop of the application: all the actions go through the same one,
+    so that they never run at the same time.
+    """
+    return control_loop
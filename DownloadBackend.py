@@ -0,0 +1,387 @@
+# coding=utf-8
+import os
+import subprocess
+import threading
+import time
+import urllib2
+
+from PartialDownload import PartialDownload
+from ProcessSupervisor import get_process_supervisor
+from SegmentedDownload import SegmentedDownload
+from Tracer import get_tracer
+
+try:
+    import youtube_dl
+except ImportError:
+    youtube_dl = None
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadRequest(object):
+    """
+    Everything a backend needs to download one video, and the handle to cancel it.
+    @param url: the url of the video page
+    @param output_template: the path of the complete file. Like in youtube-dl, it may use
+    %(id)s, %(title)s and %(ext)s
+    @param video_format: the youtube-dl format selection (ex: 'mp4' or '18/34/43')
+    @param progress: the DownloadProgress updated while downloading
+    @param max_rate: the maximum download rate, in KiB/s
+    @param partial_download: the PartialDownload of the '.part' file, if already known
+    @param trace_id: the id of the trace of the download (default: the url)
+    @param connections: the number of connections the download may use at once
+    @param max_bytes: if set, the download stops once it has the first max_bytes bytes of the file. The backend
+    never asks for more: reaching the bytes past them means the file goes on, and the download is stopped
+    """
+
+    def __init__(self, url, output_template, video_format, progress, max_rate, partial_download=None,
+                 trace_id=None, connections=1, max_bytes=None):
+        self.url = url
+        self.trace_id = trace_id or url
+        self.output_template = output_template
+        self.video_format = video_format
+        self.progress = progress
+        self.max_rate = max_rate
+        self.partial_download = partial_download
+        self.connections = connections
+        # What a cancelled download wasted is counted from here
+        self.created_at = time.time()
+        self.initial_bytes = progress.get_downloaded_bytes() if progress else 0
+
+        self.rate_limiter = None
+        self.lock = threading.Lock()
+        self.process = None
+        self.is_cancelled = False
+
+        self.max_bytes = max_bytes
+        self.has_reached_max_bytes = False
+        if max_bytes:
+            progress.call_when_size_reached(max_bytes + 1, self.stop_at_max_bytes)
+
+    def set_process(self, process):
+        """
+        Remembers the process doing the download, so that it can be stopped. If the request
+        was cancelled while the process was starting, it is stopped right away.
+        """
+        with self.lock:
+            self.process = process
+            is_cancelled = self.is_cancelled
+
+        if is_cancelled:
+            self.stop_process()
+
+    def cancel(self):
+        with self.lock:
+            self.is_cancelled = True
+        self.stop_process()
+
+    def stop_at_max_bytes(self):
+        # The limit may have been lifted since, for example when the video is watched
+        with self.lock:
+            if self.max_bytes is None or self.is_cancelled:
+                return
+            self.has_reached_max_bytes = True
+        self.cancel()
+
+    def get_bytes_before_max(self, position):
+        """
+        @return: how many bytes may still be downloaded after the given position, or None if
+        there is no limit
+        """
+        max_bytes = self.max_bytes
+        if max_bytes is None:
+            return None
+        return max(0, max_bytes - position)
+
+    def remove_max_bytes(self):
+        """
+        Lets the download go on to the end of the file, unless it already stopped at max_bytes.
+        @return: true if the download will go on
+        """
+        with self.lock:
+            self.max_bytes = None
+            return not self.has_reached_max_bytes
+
+    def stop_process(self):
+        # A process paused by the bandwidth manager must be resumed to receive the signal
+        if self.rate_limiter:
+            self.rate_limiter.close()
+
+        process = self.process
+        if process:
+            get_process_supervisor().stop(process)
+
+    def trace_first_byte(self):
+        tracer = get_tracer()
+        self.progress.call_when_size_reached(1, lambda: tracer.mark(self.trace_id, 'first_byte'))
+
+    def report_waste(self):
+        """
+        Records, for a cancelled download, the bytes it downloaded and the time it ran (until its
+        process was gone) for a video that was skipped, competing with the one being watched.
+        """
+        if not self.is_cancelled or self.has_reached_max_bytes:
+            return
+
+        wasted_bytes = max(0, self.progress.get_downloaded_bytes() - self.initial_bytes)
+        wasted_seconds = time.time() - self.created_at
+        get_tracer().mark(self.trace_id, 'download_cancelled', wasted_bytes=wasted_bytes,
+                          wasted_seconds=wasted_seconds)
+        print("Cancelled the download of %s: %d bytes and %.2fs wasted" % (self.trace_id, wasted_bytes, wasted_seconds))
+
+    def get_part_path(self):
+        """
+        @return: the path of the '.part' file the download writes, or None if it is not known yet
+        """
+        if self.partial_download is not None:
+            return self.partial_download.part_path
+        if '%(' not in self.output_template:
+            return self.output_template + '.part'
+
+        # Only known once youtube-dl has filled in the template
+        path = self.progress.get_file_path()
+        if path and not path.endswith('.part'):
+            path += '.part'
+        return path
+
+    def get_partial_download(self, part_path):
+        if self.partial_download is None or self.partial_download.part_path != part_path:
+            self.partial_download = PartialDownload(part_path)
+        return self.partial_download
+
+
+class SubprocessBackend(object):
+    """
+    Downloads each video with its own youtube-dl process, following its output for the progress.
+    """
+    name = 'subprocess'
+
+    def download(self, request):
+        """
+        Downloads the video and blocks until the download ends.
+        @param request: the DownloadRequest
+        @return: true if the file is complete, false if the download failed or was cancelled
+        """
+        request.trace_first_byte()
+        self.trim_partial_download(request)
+        supervisor = get_process_supervisor()
+        process = supervisor.start(self.get_arguments(request), stdout=subprocess.PIPE)
+        get_tracer().mark(request.trace_id, 'process_spawned')
+        request.set_process(process)
+        if request.rate_limiter:
+            request.rate_limiter.attach_process(process, request.progress)
+
+        request.progress.follow_output(process.stdout)
+        supervisor.wait(process)
+
+        # A download stopped at max_bytes may have reached the end of the file before its process was stopped
+        is_complete = process.returncode == 0 and (not request.is_cancelled or request.has_reached_max_bytes)
+        self.save_partial_download(request, is_complete)
+        request.report_waste()
+        return is_complete
+
+    def get_arguments(self, request):
+        args = ["youtube-dl"]
+        args.extend(['--output', request.output_template])
+        args.extend(['-f', request.video_format])
+        # Only a ceiling: the actual rate is set by the bandwidth manager while downloading
+        args.extend(['-r', "%dk" % request.max_rate])
+        # Resume the '.part' file of a previous download instead of starting from zero
+        args.append('--continue')
+        bytes_before_max = request.get_bytes_before_max(request.initial_bytes)
+        if bytes_before_max:
+            # The first request of youtube-dl ends at max_bytes: the process is stopped at the first bytes
+            # of the next one, unless the file ended there
+            args.extend(['--http-chunk-size', str(bytes_before_max)])
+        # One progress line per update, so that the progress can be followed
+        args.append('--newline')
+        args.append(request.url)
+        return args
+
+    def trim_partial_download(self, request):
+        # youtube-dl resumes at the end of the '.part' file: a file with holes (left by a
+        # segmented download) is cut at its first one
+        partial_download = request.partial_download
+        if partial_download is None or not os.path.exists(partial_download.part_path):
+            return
+
+        contiguous_bytes = partial_download.get_contiguous_bytes()
+        if os.path.getsize(partial_download.part_path) > contiguous_bytes:
+            with open(partial_download.part_path, 'r+b') as part_file:
+                part_file.truncate(contiguous_bytes)
+            partial_download.clear()
+            partial_download.add_range(0, contiguous_bytes)
+
+    def save_partial_download(self, request, is_complete):
+        part_path = request.get_part_path()
+        if not part_path:
+            return
+
+        partial_download = request.get_partial_download(part_path)
+        if is_complete:
+            partial_download.delete()
+        elif os.path.exists(part_path):
+            # youtube-dl writes the file from its beginning: what is on disk is what was downloaded
+            partial_download.set_total_bytes(request.progress.get_total_bytes())
+            partial_download.record_file_size()
+            partial_download.save()
+
+
+class InProcessBackend(object):
+    """
+    Resolves the media url with the youtube_dl library, imported once for the whole application,
+    and downloads it from this process. This avoids starting a new interpreter, importing the
+    extractors and fetching the page again for every video. Each download thread keeps its own
+    YoutubeDL object. Videos that can't be downloaded this way (for example formats that need
+    merging) fall back to a youtube-dl process.
+    """
+    name = 'in-process'
+
+    def __init__(self):
+        self.fallback = SubprocessBackend()
+        self.thread_state = threading.local()
+
+    def get_extractor(self, video_format):
+        extractors = getattr(self.thread_state, 'extractors', None)
+        if extractors is None:
+            extractors = self.thread_state.extractors = {}
+
+        if video_format not in extractors:
+            extractors[video_format] = youtube_dl.YoutubeDL({'format': video_format,
+                                                             'quiet': True,
+                                                             'noplaylist': True})
+        return extractors[video_format]
+
+    def resolve(self, request):
+        """
+        Returns the information of the video in the requested format (with its media 'url'),
+        or None if it must be downloaded by youtube-dl itself.
+        """
+        try:
+            info = self.get_extractor(request.video_format).extract_info(request.url, download=False)
+        except Exception as e:
+            print("In-process extraction failed (%s), using youtube-dl" % e)
+            return None
+
+        if not info.get('url') or info.get('protocol', 'http') not in ('http', 'https'):
+            return None
+        return info
+
+    def download(self, request):
+        """
+        Downloads the video and blocks until the download ends.
+        @param request: the DownloadRequest
+        @return: true if the file is complete, false if the download failed or was cancelled
+        """
+        with get_tracer().measure(request.trace_id, 'resolve'):
+            info = self.resolve(request)
+        if info is None:
+            return self.fallback.download(request)
+
+        path = self.get_path(request, info)
+        part_path = path + '.part'
+        request.progress.set_file_path(part_path)
+        request.trace_first_byte()
+        partial_download = request.get_partial_download(part_path)
+
+        try:
+            is_complete = self.download_media(request, info, partial_download)
+        except (IOError, OSError) as e:
+            print("Download of %s failed: %s" % (request.url, e))
+            is_complete = False
+
+        if is_complete:
+            os.rename(part_path, path)
+            partial_download.delete()
+        else:
+            partial_download.save()
+        request.report_waste()
+        return is_complete
+
+    def get_path(self, request, info):
+        fields = {'id': info.get('id'), 'ext': info.get('ext'), 'title': info.get('title'),
+                  'format_id': info.get('format_id')}
+        return request.output_template % fields
+
+    def download_media(self, request, info, partial_download):
+        start = partial_download.get_contiguous_bytes()
+        response = self.open_media(info, start)
+
+        if start and response.getcode() != 206:
+            # The server ignored the range: start again from the beginning
+            start = 0
+            partial_download.clear()
+
+        total_bytes = self.get_total_bytes(response, start)
+        partial_download.set_total_bytes(total_bytes)
+        request.progress.update(start, total_bytes)
+
+        if request.connections > 1 and total_bytes and self.accepts_ranges(response) and request.max_bytes is None:
+            segmented_download = SegmentedDownload(request, info, partial_download, request.connections)
+            return segmented_download.download(response)
+
+        mode = 'r+b' if os.path.exists(partial_download.part_path) else 'wb'
+        with open(partial_download.part_path, mode) as part_file:
+            part_file.seek(start)
+            position = start
+
+            while not request.is_cancelled:
+                # Never past max_bytes
+                bytes_before_max = request.get_bytes_before_max(position)
+                if bytes_before_max == 0:
+                    request.stop_at_max_bytes()
+                    break
+                chunk = response.read(CHUNK_SIZE if bytes_before_max is None else min(CHUNK_SIZE, bytes_before_max))
+                if not chunk:
+                    break
+
+                if request.rate_limiter:
+                    request.rate_limiter.consume(len(chunk))
+
+                part_file.write(chunk)
+                part_file.flush()
+                partial_download.add_range(position, position + len(chunk))
+                position += len(chunk)
+                request.progress.update(position, total_bytes)
+
+        if total_bytes is not None and position >= total_bytes:
+            # Complete, even if it was stopped at max_bytes with its last bytes
+            return True
+        return not request.is_cancelled and total_bytes is None
+
+    def open_media(self, info, start):
+        media_request = urllib2.Request(info['url'], headers=info.get('http_headers') or {})
+        if start:
+            media_request.add_header('Range', 'bytes=%d-' % start)
+        return urllib2.urlopen(media_request)
+
+    def accepts_ranges(self, response):
+        return response.getcode() == 206 or response.info().getheader('Accept-Ranges') == 'bytes'
+
+    def get_total_bytes(self, response, start):
+        content_range = response.info().getheader('Content-Range')
+        if content_range and '/' in content_range and not content_range.endswith('*'):
+            return int(content_range.split('/')[-1])
+
+        content_length = response.info().getheader('Content-Length')
+        if content_length:
+            return start + int(content_length)
+
+        return None
+
+
+default_backend = None
+default_backend_lock = threading.Lock()
+
+
+def get_download_backend():
+    """
+    Returns the backend used by all the downloads: in-process if the youtube_dl library
+    is installed, one youtube-dl process per video otherwise.
+    """
+    global default_backend
+    with default_backend_lock:
+        if default_backend is None:
+            default_backend = InProcessBackend() if youtube_dl else SubprocessBackend()
+        return default_backend
@@ -0,0 +1,255 @@
+# coding=utf-8
+import os
+import re
+import threading
+import time
+from collections import deque
+
+
+PROGRESS_LINE = re.compile(r'\[download\]\s+(?P<percent>[\d.]+)% of\s+~?\s*(?P<size>[\d.]+)(?P<unit>[KMGT]?i?B)')
+DESTINATION_LINE = re.compile(r'\[download\] Destination: (?P<path>.+)$')
+ALREADY_DOWNLOADED_LINE = re.compile(r'\[download\] (?P<path>.+) has already been downloaded')
+PART_SUFFIX = '.part'
+
+UNITS = {'B': 1,
+         'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4,
+         'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4}
+
+POLL_INTERVAL = 0.5
+# The download rate is measured over the last RATE_WINDOW seconds, once they span at least MIN_RATE_SPAN
+RATE_WINDOW = 3.0
+MIN_RATE_SPAN = 0.3
+
+
+class DownloadProgress(object):
+    """
+    Thread-safe record of how many bytes of a download are on disk, and how fast they arrive.
+    The download side reports progress (parsed from the youtube-dl output, or read from the file
+    size when no output is available) and readers either block until a condition (like a byte
+    threshold) is met or register a callback that is called as soon as it is.
+    @param file_path: the path of the file being downloaded
+    @param poll_interval: how often the file size is checked when no progress is reported
+    """
+
+    def __init__(self, file_path=None, poll_interval=POLL_INTERVAL):
+        self.condition = threading.Condition()
+        self.file_path = file_path
+        self.poll_interval = poll_interval
+
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.is_finished = False
+        self.has_reported_progress = False
+        self.rate_samples = deque()
+
+        self.condition_callbacks = []
+
+    def get_file_path(self):
+        return self.file_path
+
+    def get_downloaded_bytes(self):
+        return self.downloaded_bytes
+
+    def get_total_bytes(self):
+        return self.total_bytes
+
+    def has_finished(self):
+        return self.is_finished
+
+    def get_download_rate(self):
+        """
+        @return: the recent download rate, in bytes per second, or None if it is not known yet
+        """
+        with self.condition:
+            if len(self.rate_samples) < 2:
+                return None
+
+            (first_time, first_bytes) = self.rate_samples[0]
+            (last_time, last_bytes) = self.rate_samples[-1]
+            if last_time - first_time < MIN_RATE_SPAN:
+                return None
+            return (last_bytes - first_bytes) / (last_time - first_time)
+
+    def set_file_path(self, file_path):
+        with self.condition:
+            self.file_path = file_path
+            self.condition.notify_all()
+
+    def update(self, downloaded_bytes, total_bytes=None):
+        """
+        Records the number of bytes downloaded so far and wakes up everyone waiting
+        on a size that has now been reached.
+        @param downloaded_bytes: the number of bytes on disk
+        @param total_bytes: the expected size of the complete file, if known
+        """
+        with self.condition:
+            self.has_reported_progress = True
+            self.downloaded_bytes = max(self.downloaded_bytes, int(downloaded_bytes))
+            if total_bytes:
+                self.total_bytes = int(total_bytes)
+            self.add_rate_sample()
+            self.condition.notify_all()
+            callbacks = self.pop_reached_callbacks()
+
+        self.run_callbacks(callbacks)
+
+    def finish(self):
+        """
+        Marks the download as ended (complete or not). Every waiter is released, since
+        no more bytes will arrive. If the '.part' file was renamed to the complete one,
+        the path becomes the one of the complete file.
+        """
+        with self.condition:
+            self.is_finished = True
+            path = self.file_path
+            if path and path.endswith(PART_SUFFIX) and not os.path.exists(path) \
+                    and os.path.exists(path[:-len(PART_SUFFIX)]):
+                self.file_path = path[:-len(PART_SUFFIX)]
+            self.condition.notify_all()
+            callbacks = self.pop_reached_callbacks()
+
+        self.run_callbacks(callbacks)
+
+    def parse_output_line(self, line):
+        """
+        Updates the progress from a line printed by youtube-dl. Lines that carry no
+        progress information are ignored.
+        @param line: the output line
+        """
+        line = line.strip()
+
+        match = DESTINATION_LINE.search(line)
+        if match:
+            # youtube-dl names the complete file, but writes the '.part' one until the end
+            path = match.group('path')
+            self.set_file_path(path if path.endswith(PART_SUFFIX) else path + PART_SUFFIX)
+            return
+
+        match = ALREADY_DOWNLOADED_LINE.search(line)
+        if match:
+            self.set_file_path(match.group('path'))
+            return
+
+        match = PROGRESS_LINE.search(line)
+        if match and match.group('unit') in UNITS:
+            total_bytes = float(match.group('size')) * UNITS[match.group('unit')]
+            downloaded_bytes = total_bytes * float(match.group('percent')) / 100
+            self.update(downloaded_bytes, total_bytes)
+
+    def follow_output(self, stream):
+        """
+        Reads the output of the download process until it is closed, updating the
+        progress from each line. Must be run from the download thread.
+        @param stream: the stdout of the download process
+        """
+        for line in iter(stream.readline, ''):
+            self.parse_output_line(line)
+
+    def wait_for_file_path(self, timeout=None):
+        """
+        Blocks until the downloader has announced the path of the file it writes, or the
+        download has ended.
+        @param timeout: the maximum number of seconds to wait (default: no limit)
+        @return: the path of the file, or None if it is still unknown
+        """
+        deadline = timeout is not None and time.time() + timeout
+
+        with self.condition:
+            while self.file_path is None and not self.is_finished:
+                remaining = None
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self.condition.wait(remaining)
+
+            return self.file_path
+
+    def has_reached(self, size):
+        return self.is_finished or self.downloaded_bytes >= size
+
+    def wait_until_size(self, size, timeout=None):
+        """
+        Blocks until at least size bytes have been downloaded or the download has ended.
+        If the downloader does not report its progress, falls back to checking the file size.
+        @param size: the minimum number of bytes
+        @param timeout: the maximum number of seconds to wait (default: no limit)
+        @return: true if the size was reached (or the download ended), false on timeout
+        """
+        return self.wait_until(lambda progress: progress.downloaded_bytes >= size, timeout)
+
+    def wait_until(self, condition, timeout=None):
+        """
+        Blocks until the condition is met or the download has ended.
+        @param condition: a function taking this progress, called while holding its lock
+        @param timeout: the maximum number of seconds to wait (default: no limit)
+        @return: true if the condition was met (or the download ended), false on timeout
+        """
+        deadline = timeout is not None and time.time() + timeout
+
+        with self.condition:
+            while not self.is_met(condition):
+                if not self.has_reported_progress:
+                    self.refresh_from_file_size()
+                    if self.is_met(condition):
+                        break
+
+                # Once the downloader reports its progress, every update wakes the waiters: no polling
+                remaining = None if self.has_reported_progress else self.poll_interval
+                if deadline:
+                    time_left = deadline - time.time()
+                    if time_left <= 0:
+                        return False
+                    remaining = time_left if remaining is None else min(remaining, time_left)
+
+                self.condition.wait(remaining)
+
+            return True
+
+    def call_when_size_reached(self, size, callback):
+        """
+        Calls the callback (from the download thread) as soon as at least size bytes have
+        been downloaded or the download has ended. If that is already the case, the callback
+        is called immediately. Never blocks.
+        @param size: the minimum number of bytes
+        @param callback: a function without arguments
+        """
+        self.call_when(lambda progress: progress.downloaded_bytes >= size, callback)
+
+    def call_when(self, condition, callback):
+        """
+        Calls the callback (from the download thread) as soon as the condition is met or the
+        download has ended. The condition is checked again at every update. Never blocks.
+        @param condition: a function taking this progress, called while holding its lock
+        @param callback: a function without arguments
+        """
+        with self.condition:
+            if not self.is_met(condition):
+                self.condition_callbacks.append((condition, callback))
+                return
+
+        callback()
+
+    def is_met(self, condition):
+        return self.is_finished or condition(self)
+
+    def add_rate_sample(self):
+        now = time.time()
+        self.rate_samples.append((now, self.downloaded_bytes))
+        while len(self.rate_samples) > 2 and now - self.rate_samples[1][0] >= RATE_WINDOW:
+            self.rate_samples.popleft()
+
+    def refresh_from_file_size(self):
+        path = self.file_path
+        if path and os.path.exists(path):
+            self.downloaded_bytes = max(self.downloaded_bytes, os.path.getsize(path))
+
+    def pop_reached_callbacks(self):
+        reached = [(condition, callback) for (condition, callback) in self.condition_callbacks
+                   if self.is_met(condition)]
+        self.condition_callbacks = [entry for entry in self.condition_callbacks if entry not in reached]
+        return [callback for (condition, callback) in reached]
+
+    def run_callbacks(self, callbacks):
+        for callback in callbacks:
+            callback()
@@ -0,0 +1,221 @@
+# coding=utf-8
+import itertools
+import threading
+from Queue import PriorityQueue
+
+
+PRIORITY_CURRENT = 0
+PRIORITY_PREFETCH = 10
+
+MAX_CONCURRENT_DOWNLOADS = 3
+
+DOWNLOADS = 'downloads'
+SEARCH_PAGES = 'search_pages'
+
+worker_state = threading.local()
+
+
+class DownloadJob(object):
+    """
+    Handle on a function submitted to the scheduler. It can be cancelled, waited on,
+    and notifies its callbacks when it ends.
+    @param function: the function to run
+    @param args: the arguments of the function
+    @param priority: the priority of the job (lower runs first)
+    @param callback: called with the result if the job ends without being cancelled
+    @param on_cancel: called (from the cancelling thread) if the job is cancelled while running
+    """
+
+    def __init__(self, function, args=(), priority=PRIORITY_PREFETCH, callback=None, on_cancel=None):
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.callback = callback
+        self.on_cancel = on_cancel
+
+        self.lock = threading.Lock()
+        self.done_event = threading.Event()
+        self.is_running = False
+        self.is_cancelled = False
+        self.result = None
+        self.exception = None
+        self.done_callbacks = []
+
+    def cancel(self):
+        """
+        Cancels the job. A pending job will never run. A running job is told to stop
+        through its on_cancel function.
+        """
+        with self.lock:
+            if self.is_cancelled or self.done_event.is_set():
+                return
+            self.is_cancelled = True
+            was_running = self.is_running
+
+        if was_running:
+            if self.on_cancel:
+                self.on_cancel()
+        else:
+            self.finish()
+
+    def was_cancelled(self):
+        return self.is_cancelled
+
+    def is_done(self):
+        return self.done_event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the job has ended or was cancelled.
+        @param timeout: the maximum number of seconds to wait (default: no limit)
+        @return: true if the job has ended
+        """
+        self.done_event.wait(timeout)
+        return self.done_event.is_set()
+
+    def get_result(self, timeout=None):
+        """
+        Waits for the job and returns its result. Raises the exception of the job if it failed.
+        """
+        self.wait(timeout)
+        if self.exception:
+            raise self.exception
+        return self.result
+
+    def add_done_callback(self, done_callback):
+        """
+        Calls done_callback with the job when it ends, whether it succeeded, failed or was cancelled.
+        """
+        with self.lock:
+            if not self.done_event.is_set():
+                self.done_callbacks.append(done_callback)
+                return
+
+        done_callback(self)
+
+    def is_pending(self):
+        return not (self.is_running or self.is_cancelled or self.done_event.is_set())
+
+    def run(self):
+        with self.lock:
+            # A job whose priority changed is in the queue more than once: only the first entry runs it
+            if not self.is_pending():
+                return
+            self.is_running = True
+
+        worker_state.current_job = self
+        try:
+            self.result = self.function(*self.args)
+        except Exception as e:
+            self.exception = e
+            print("Download job failed: %s" % e)
+        finally:
+            worker_state.current_job = None
+
+        if self.callback and not self.is_cancelled and not self.exception:
+            self.callback(self.result)
+
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.is_running = False
+            self.done_event.set()
+            done_callbacks, self.done_callbacks = self.done_callbacks, []
+
+        for done_callback in done_callbacks:
+            done_callback(self)
+
+
+class DownloadScheduler(object):
+    """
+    Long-lived pool of download threads. Jobs are run by order of priority (the current
+    video before the prefetched ones), at most max_concurrent_downloads at the same time.
+    @param max_concurrent_downloads: the maximum number of jobs running at the same time
+    """
+
+    def __init__(self, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS):
+        self.queue = PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+        self.max_concurrent_downloads = 0
+        self.number_of_workers = 0
+        self.set_max_concurrent_downloads(max_concurrent_downloads)
+
+    def submit(self, function, args=(), priority=PRIORITY_PREFETCH, callback=None, on_cancel=None):
+        """
+        Schedules the function to be run by a download thread.
+        @param function: the function to run
+        @param args: the arguments of the function
+        @param priority: the priority of the job (PRIORITY_CURRENT or PRIORITY_PREFETCH)
+        @param callback: called with the result if the job ends without being cancelled
+        @param on_cancel: called if the job is cancelled while running
+        @return: the DownloadJob
+        """
+        job = DownloadJob(function, args, priority, callback, on_cancel)
+        self.queue.put((priority, next(self.sequence), job))
+        return job
+
+    def change_priority(self, job, priority):
+        """
+        Changes the priority of a job that has not started yet. Has no effect on running jobs.
+        @param job: the DownloadJob
+        @param priority: the new priority
+        """
+        with job.lock:
+            if not job.is_pending() or job.priority == priority:
+                return
+            job.priority = priority
+            self.queue.put((priority, next(self.sequence), job))
+
+    def set_max_concurrent_downloads(self, max_concurrent_downloads):
+        """
+        Changes the concurrency limit. New threads are started if needed, and extra ones
+        stop after their current job.
+        """
+        with self.lock:
+            self.max_concurrent_downloads = max(1, max_concurrent_downloads)
+            while self.number_of_workers < self.max_concurrent_downloads:
+                self.number_of_workers += 1
+                self.start_worker()
+
+    def start_worker(self):
+        worker = threading.Thread(target=self.work, name="download-worker")
+        worker.daemon = True
+        worker.start()
+
+    def work(self):
+        while True:
+            (priority, sequence, job) = self.queue.get()
+            job.run()
+
+            with self.lock:
+                if self.number_of_workers > self.max_concurrent_downloads:
+                    self.number_of_workers -= 1
+                    return
+
+
+def get_current_job():
+    """
+    Returns the job run by the calling thread, or None if it is not a download thread.
+    """
+    return getattr(worker_state, 'current_job', None)
+
+
+shared_schedulers = {}
+shared_schedulers_lock = threading.Lock()
+
+
+def get_shared_scheduler(name=DOWNLOADS, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS):
+    """
+    Returns the scheduler with the given name, shared by the whole application. By default,
+    the one of the video downloads. Other kinds of jobs (like fetching pages of search results)
+    get their own scheduler, so that they never wait behind a download.
+    @param name: the name of the scheduler
+    @param max_concurrent_downloads: the concurrency limit, if the scheduler must be created
+    """
+    with shared_schedulers_lock:
+        if name not in shared_schedulers:
+            shared_schedulers[name] = DownloadScheduler(max_concurrent_downloads)
+        return shared_schedulers[name]
@@ -1,44 +1,127 @@
 # coding=utf-8
+import functools
+import threading
+
 import utils
+from DownloadScheduler import get_shared_scheduler, PRIORITY_CURRENT, PRIORITY_PREFETCH, SEARCH_PAGES
+from PrefetchPolicy import get_prefetch_policy
+from ResultStore import ResultStore
+from StreamServer import get_stream_server
 from Video import Video
 
 
-DEFAULT_SIZE = 2 * 1024 ** 2  # 2 MB
+DEFAULT_PAGE_SIZE = 10
+PAGE_READ_AHEAD = 3
+# A jump and a read-ahead may need different pages at the same time
+MAX_CONCURRENT_PAGE_FETCHES = 3
 
 
 class Downloader(object):
-    def __init__(self, search_terms, directory):
+    def __init__(self, search_terms, directory, prefetch_window=None, page_size=DEFAULT_PAGE_SIZE):
         self.prefetch = False
+        # How many videos are prefetched, and how much of each, depends on how the user watches them
+        self.prefetch_policy = get_prefetch_policy()
+        # If set, at most this many videos are prefetched
+        self.prefetch_window = prefetch_window
 
         self.search_terms = search_terms
         self.directory = directory
 
-        self.videos = []
-        self.videos = self.get_next_10_videos()
+        self.page_size = page_size
+        self.page_scheduler = get_shared_scheduler(SEARCH_PAGES, max_concurrent_downloads=MAX_CONCURRENT_PAGE_FETCHES)
+        self.page_lock = threading.Lock()
+        self.page_jobs = {}
+        self.results = ResultStore(page_size, self.create_video)
+
         self.current_video = None
         self.current_video_index = 0
+        # Not waited for here: the first video waits for it, on the thread that needs it
+        self.start_fetching_page(0, PRIORITY_CURRENT)
+
+    def get_page_of_metadata(self, page_number):
+        # Youtube counts the results from 1
+        return self.get_metadata(self.results.get_first_index(page_number) + 1)
+
+    def create_video(self, metadata, index):
+        return Video(metadata, index, self.directory)
+
+    def forget_page_job(self, page_number, job):
+        # Also called when the fetch failed, so that the next call tries again
+        with self.page_lock:
+            if self.page_jobs.get(page_number) is job:
+                del self.page_jobs[page_number]
+
+    def read_ahead_next_page(self):
+        """
+        When the current video gets close to the end of its page, starts fetching the next page
+        in the background, so that moving past it doesn't wait for the network.
+        """
+        index = self.current_video_index + PAGE_READ_AHEAD
+        if not self.results.is_known(index):
+            self.start_fetching_page(self.results.get_page_number(index), PRIORITY_PREFETCH)
+
+    def start_fetching_page(self, page_number, priority):
+        """
+        Starts fetching a page of results, unless it is known or already being fetched (its
+        priority is then raised if needed).
+        @return: the DownloadJob of the page, or None if it is known
+        """
+        is_new_job = False
+        with self.page_lock:
+            if self.results.has_page(page_number) or self.results.is_past_end(self.results.get_first_index(page_number)):
+                return None
+
+            job = self.page_jobs.get(page_number)
+            if job is None:
+                job = self.page_scheduler.submit(self.get_page_of_metadata, args=(page_number,),
+                                                 priority=priority,
+                                                 callback=functools.partial(self.results.add_page, page_number))
+                self.page_jobs[page_number] = job
+                is_new_job = True
+            elif priority < job.priority:
+                self.page_scheduler.change_priority(job, priority)
+
+        if is_new_job:
+            job.add_done_callback(functools.partial(self.forget_page_job, page_number))
+        return job
+
+    def load_video(self, index):
+        """
+        Waits until the video with the given index is known, fetching its page (and only it) if
+        needed. A page already being fetched in the background is waited for instead of fetched again.
+        """
+        job = self.start_fetching_page(self.results.get_page_number(index), PRIORITY_CURRENT)
+        if job:
+            job.get_result()
+
+    def call_when_video_is_known(self, index, callback):
+        """
+        Calls the callback once the video with the given index is known, or once it is sure
+        there is no such video, without blocking the calling thread: its page is fetched by a
+        page thread, which calls the callback.
+        """
+        job = None
+        if not self.results.is_known(index):
+            job = self.start_fetching_page(self.results.get_page_number(index), PRIORITY_CURRENT)
+
+        if job:
+            job.add_done_callback(lambda job: callback())
+        else:
+            callback()
 
-    def get_next_10_videos(self):
-        videos = []
-
-        start_index = self.get_current_number_of_videos()
-        entries = self.get_entries(start_index)
-
-        for (index, entry) in enumerate(entries, start_index):
-            video = Video(entry, index, self.directory)
-            videos.append(video)
+    def has_video(self, index):
+        return self.results.has(index)
 
-        return videos
+    def get_video(self, index):
+        return self.results.get(index)
 
-    def get_current_number_of_videos(self):
-        try:
-            return len(self.videos)
-        except AttributeError:
-            return 0
+    def get_video_after(self, video):
+        # Only a video already known: it never waits for a page of results
+        return self.results.get(video.get_index() + 1)
 
-    def get_entries(self, start_index):
-        json = utils.download_json(self.search_terms, start_index)
-        return utils.get_entries(json)
+    def get_metadata(self, start_index):
+        json = utils.download_json(self.search_terms, start_index, self.page_size)
+        return utils.get_metadata(json)
 
     def is_downloading(self):
         return self.current_video and self.current_video.is_downloading
@@ -49,12 +132,18 @@ class Downloader(object):
     def get_current_video_file_path(self):
         return self.current_video.get_file_path()
 
+    def get_current_video_stream_url(self):
+        return self.current_video.get_stream_url()
+
     def get_current_video_title(self):
         return self.current_video.get_title()
 
     def get_current_video_length(self):
         return self.current_video.get_length()
 
+    def mark_current_video_as_played(self):
+        self.current_video.mark_as_played()
+
     def get_current_video_index(self):
         return self.current_video_index
 
@@ -77,63 +166,119 @@ class Downloader(object):
     def download_current_video(self):
         video = self.get_current_video()
 
-        if video != self.current_video:
-            self.stop_download()
-
         self.current_video = video
+        video.set_full_download_speed()
 
         if not video.has_been_downloaded():
             video.download()
 
+        self.update_prefetch_window()
+        # The videos left far behind (or ahead) only keep their metadata, or nothing
+        self.unpublish_streams(self.results.retain_around(video.get_index()))
+
+    def update_prefetch_window(self):
+        """
+        Stops the downloads of the videos that are no longer current or about to be watched,
+        then starts prefetching the next videos (or only their heads, as the prefetch policy
+        decides), the closest ones first.
+        """
+        plan = self.get_prefetch_plan()
+        window = self.get_prefetch_window_indices(len(plan))
+
+        for video in self.results.get_videos():
+            if video is not self.current_video and video.get_index() not in window:
+                video.stop_downloading()
+
+        for index in window:
+            distance = index - self.current_video_index
+            video = self.results.get(index)
+            video.set_prefetching(distance)
+            video.download(plan[distance - 1])
+
+    def get_prefetch_plan(self):
+        plan = self.prefetch_policy.get_plan()
+        if self.prefetch_window is not None:
+            plan = plan[:self.prefetch_window]
+        return plan
+
+    def get_prefetch_window_indices(self, size):
+        # Only the videos already known are prefetched: it never waits for a new page of results
+        first_index = self.current_video_index + 1
+        return [index for index in range(first_index, first_index + size) if self.results.has(index)]
+
     def get_current_video(self):
         if self.must_get_new_videos():
-            self.videos.extend(self.get_next_10_videos())
+            self.load_video(self.current_video_index)
 
-        return self.videos[self.current_video_index]
+        self.read_ahead_next_page()
+        video = self.results.get(self.current_video_index)
+        if video is None:
+            raise IndexError("No video with index %d" % self.current_video_index)
+        return video
 
     def must_get_new_videos(self):
-        return self.current_video_index >= len(self.videos)
+        return not self.results.is_known(self.current_video_index)
 
     def stop_download(self):
         if self.is_downloading():
             self.current_video.stop_downloading()
 
+    def stop_all_downloads(self):
+        for video in self.results.get_videos():
+            video.stop_downloading()
+
+    def unpublish_streams(self, videos):
+        # The stream server would otherwise keep a stream for every video played
+        stream_server = get_stream_server()
+        for video in videos:
+            stream_server.unpublish(video.video_id)
+
     def is_there_video_to_download(self):
-        if not self.must_get_new_videos():
-            return True
+        if self.must_get_new_videos():
+            self.load_video(self.current_video_index)
 
-        new_videos = self.get_next_10_videos()
-        if new_videos:
-            self.videos.extend(new_videos)
-        else:
-            return False
+        return self.results.has(self.current_video_index)
 
     def is_video_already_downloaded(self, index):
-        return 0 < index < len(self.videos) and self.videos[index].has_been_downloaded()
+        video = self.results.get(index)
+        return video is not None and video.has_been_downloaded()
 
     def is_video_downloading(self, index):
-        return 0 < index < len(self.videos) and self.videos[index].is_downloading()
+        video = self.results.get(index)
+        return video is not None and video.is_downloading
 
     def get_file_path_of_video_with_index(self, index):
         self.check_index(index)
 
-        if not self.videos[index].has_file_been_created():
+        video = self.results.get(index)
+        if not video.has_file_been_created():
             raise Exception("File with index %d has not been created." % index)
 
-        return self.videos[index].get_file_path()
+        return video.get_file_path()
 
     def check_index(self, index):
-        if not (0 <= index < len(self.videos)):
+        if not self.results.has(index):
             raise Exception("Invalid index: %d" % index)
-        else:
-            print("0 < %d < %d" % (index, len(self.videos)))
-
-    def wait_while_video_is_small(self, index, size=DEFAULT_SIZE):
-        self.check_index(index)
-        self.videos[index].wait_while_file_is_small(size)
 
-    def wait_while_current_video_is_small(self, size=DEFAULT_SIZE):
-        self.current_video.wait_while_file_is_small(size)
+    def call_when_current_video_is_playable(self, callback):
+        self.current_video.call_when_playable(callback)
+
+    def get_memory_report(self):
+        """
+        @return: what the search holds in memory: its pages of results and videos (see
+        ResultStore.get_memory_report), the pages being fetched, and the streams of the stream
+        server (of every search)
+        """
+        report = self.results.get_memory_report()
+        with self.page_lock:
+            report['page_fetches'] = len(self.page_jobs)
+        report['streams'] = get_stream_server().get_number_of_streams()
+        return report
 
     def destroy(self):
-        self.stop_download()
\ No newline at end of file
+        with self.page_lock:
+            jobs = self.page_jobs.values()
+        for job in jobs:
+            job.cancel()
+        self.stop_all_downloads()
+        self.unpublish_streams(self.results.get_videos())
\ No newline at end of file
@@ -0,0 +1,143 @@
+# coding=utf-8
+import threading
+
+
+# Only this share of the measured download rate is counted on, since it varies
+RATE_SAFETY_FACTOR = 0.8
+# How long the start of a video may wait for a better quality, in seconds
+MAX_START_DELAY = 3
+# Weight of the last measurement in the estimated download rate
+RATE_SMOOTHING = 0.5
+
+
+class Quality(object):
+    """
+    One step of a quality ladder: the youtube formats (itags) that give it, by preference,
+    and their approximate bitrate (video and audio).
+    @param name: the name of the quality (ex: 'medium')
+    @param formats: the itags of the quality
+    @param bitrate: the bitrate, in kbit/s
+    """
+
+    def __init__(self, name, formats, bitrate):
+        self.name = name
+        self.formats = formats
+        self.bitrate = bitrate
+
+    def get_bytes_per_second(self):
+        return self.bitrate * 1000 / 8.0
+
+    def __repr__(self):
+        return "Quality(%r)" % self.name
+
+
+# Both ladders have the same steps, so that the selected step applies to either one. The
+# youtube formats of the lowest step are 3GP: the files named and served as MP4 get the
+# smallest MP4 instead
+MP4_LADDER = [Quality('low', ['worst[ext=mp4]'], 250),
+              Quality('medium', ['18'], 700),
+              Quality('high', ['22'], 2500),
+              Quality('full-hd', ['37'], 4500)]
+
+ANY_CONTAINER_LADDER = [Quality('low', ['17', '5', '36'], 250),
+                        Quality('medium', ['18', '34', '43'], 700),
+                        Quality('high', ['22', '45', '35', '44'], 2500),
+                        Quality('full-hd', ['37', '46'], 4500)]
+
+DEFAULT_LEVEL = 1
+
+
+class FormatSelector(object):
+    """
+    Picks the quality of each video from the download rate measured on the previous ones and
+    the length of the video: the highest quality that downloads faster than it plays, or whose
+    missing bytes can be downloaded in MAX_START_DELAY seconds. It steps up one quality at a time,
+    as downloads keep ahead of playback, and steps down at once when they fall behind.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.level = DEFAULT_LEVEL
+        self.estimated_rate = None
+
+    def get_estimated_rate(self):
+        """
+        @return: the estimated download rate, in bytes per second, or None if nothing was measured
+        """
+        return self.estimated_rate
+
+    def select(self, length=None, ladder=MP4_LADDER, is_prefetching=False):
+        """
+        Picks the quality of the next video to download.
+        @param length: the length of the video, in seconds (None if unknown)
+        @param ladder: the qualities to pick from
+        @param is_prefetching: true if the video is only prefetched: it doesn't step the quality up
+        @return: the Quality
+        """
+        with self.lock:
+            if self.estimated_rate is None:
+                return ladder[self.level]
+
+            affordable_level = self.get_affordable_level(length, ladder)
+            if is_prefetching:
+                return ladder[min(affordable_level, self.level)]
+
+            self.level = min(affordable_level, self.level + 1)
+            return ladder[self.level]
+
+    def get_affordable_level(self, length, ladder):
+        budget = self.estimated_rate * RATE_SAFETY_FACTOR
+        if length:
+            # A short video can wait for the bytes the download can't keep up with
+            budget += self.estimated_rate * MAX_START_DELAY / float(length)
+
+        affordable_level = 0
+        for (level, quality) in enumerate(ladder):
+            if quality.get_bytes_per_second() <= budget:
+                affordable_level = level
+        return affordable_level
+
+    def report(self, quality, download_rate):
+        """
+        Records the download rate measured while downloading a video being watched.
+        @param quality: the Quality of the video
+        @param download_rate: the measured rate, in bytes per second (None if unknown)
+        @return: true if the download kept ahead of playback
+        """
+        if download_rate is None:
+            return True
+
+        kept_ahead = download_rate * RATE_SAFETY_FACTOR >= quality.get_bytes_per_second()
+        with self.lock:
+            if self.estimated_rate is None or not kept_ahead:
+                # Falling behind is not smoothed: the next video must not underrun too
+                self.estimated_rate = download_rate
+            else:
+                self.estimated_rate += RATE_SMOOTHING * (download_rate - self.estimated_rate)
+
+        return kept_ahead
+
+
+def get_format(quality, ladder=MP4_LADDER):
+    """
+    Returns the youtube-dl format selection for the quality: its formats, then those of the lower
+    qualities, for the videos that don't have it.
+    @param quality: the Quality
+    @param ladder: the ladder of the quality
+    @return: the format selection (ex: '18/36/17')
+    """
+    level = ladder.index(quality)
+    formats = []
+    for lower_quality in reversed(ladder[:level + 1]):
+        formats.extend(lower_quality.formats)
+    return '/'.join(formats)
+
+
+format_selector = FormatSelector()
+
+
+def get_format_selector():
+    """
+    Returns the format selector shared by all the downloads: they all go through the same link.
+    """
+    return format_selector
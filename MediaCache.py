@@ -0,0 +1,135 @@
+# coding=utf-8
+import json
+import os
+import threading
+import time
+
+import utils
+
+
+INDEX_FILE_NAME = 'cache_index.json'
+DEFAULT_MAX_CACHE_SIZE = 2 * 1024 ** 3  # 2 GB
+
+
+class MediaCache(object):
+    """
+    Index of the complete videos stored in a directory, kept on disk between sessions.
+    Each video id maps to its file path, size, format and the last time it was played.
+    When the files take more than max_size bytes, the least recently played ones are deleted.
+    @param directory: the directory of the videos (and of the index)
+    @param max_size: the maximum number of bytes taken by the videos
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_CACHE_SIZE):
+        self.directory = utils.make_directory(directory)
+        self.index_path = os.path.join(self.directory, INDEX_FILE_NAME)
+        self.max_size = max_size
+
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        try:
+            with open(self.index_path, 'w') as index_file:
+                json.dump(self.entries, index_file)
+        except (IOError, OSError) as e:
+            print("Unable to save the cache index: %s" % e)
+
+    def get_path(self, video_id):
+        """
+        Returns the path of the cached video, or None if it isn't cached. Entries whose file
+        was deleted behind the cache's back are forgotten.
+        @param video_id: the id of the video
+        @return: the path of the file, or None
+        """
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return None
+
+            if not os.path.exists(entry['path']):
+                del self.entries[video_id]
+                self.save()
+                return None
+
+            return entry['path']
+
+    def contains(self, video_id):
+        return self.get_path(video_id) is not None
+
+    def add(self, video_id, path, video_format=None):
+        """
+        Adds a complete video to the cache, then evicts the least recently played videos
+        if the cache is too big.
+        @param video_id: the id of the video
+        @param path: the path of the complete file
+        @param video_format: the format of the file (ex: 'mp4')
+        """
+        if not video_id or not os.path.exists(path):
+            return
+
+        if video_format is None:
+            video_format = os.path.splitext(path)[1].lstrip('.')
+
+        with self.lock:
+            self.entries[video_id] = {'path': path,
+                                      'size': os.path.getsize(path),
+                                      'format': video_format,
+                                      'last_played': time.time()}
+            self.evict(protected_video_id=video_id)
+            self.save()
+
+    def mark_as_played(self, video_id):
+        with self.lock:
+            if video_id in self.entries:
+                self.entries[video_id]['last_played'] = time.time()
+                self.save()
+
+    def get_size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def evict(self, protected_video_id=None):
+        """
+        Deletes the least recently played videos until the cache fits in its budget.
+        Must be called with the lock held.
+        @param protected_video_id: a video that must not be deleted (the one just added)
+        """
+        by_last_played = sorted(self.entries.items(), key=lambda item: item[1]['last_played'])
+
+        size = self.get_size()
+        for (video_id, entry) in by_last_played:
+            if size <= self.max_size:
+                break
+            if video_id == protected_video_id:
+                continue
+
+            print("Evicting from cache: %s" % entry['path'])
+            try:
+                os.remove(entry['path'])
+            except (IOError, OSError):
+                pass
+
+            size -= entry['size']
+            del self.entries[video_id]
+
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+def get_media_cache(directory):
+    """
+    Returns the cache of the given directory, shared by everyone using that directory.
+    """
+    directory = utils.make_directory(directory)
+    with caches_lock:
+        if directory not in caches:
+            caches[directory] = MediaCache(directory)
+        return caches[directory]
@@ -1,5 +1,5 @@
 # coding=utf-8
-import Queue
+from PlaybackState import PlaybackState
 
 
 class MediaPlayer(object):
@@ -7,6 +7,10 @@ class MediaPlayer(object):
         self.media_player = mplayer_controller
         self.is_paused = True
         self.current_video_path = None
+        # The file queued after the current one: mplayer goes on to it without loading it then
+        self.preloaded_path = None
+        # Fed by the output of mplayer: reading the position or length never queries it
+        self.playback_state = PlaybackState()
 
     def is_video_playing(self):
         return not self.is_video_paused() and self.media_player.playing
@@ -21,38 +25,77 @@ class MediaPlayer(object):
         if not self.is_paused:
             self.invert_player_paused_state()
             self.is_paused = True
+            self.playback_state.pause()
 
     def unpause(self):
         if self.is_paused:
             self.invert_player_paused_state()
             self.is_paused = False
+            self.playback_state.unpause()
 
     def invert_player_paused_state(self):
         self.media_player.Pause()
 
     def reset(self):
         self.media_player.Seek(0, type_=2)
+        self.playback_state.set_position(0)
 
     def play_file(self, path):
+        # Replaces the whole playlist of mplayer, the preloaded file too
         self.media_player.Loadfile(path)
+        self.playback_state.on_file_loaded()
         self.current_video_path = path
+        self.preloaded_path = None
         self.is_paused = False
 
+    def preload_file(self, path):
+        """
+        Queues a file after the current one, in the same mplayer process. It plays as soon as the
+        current file ends, or when play_preloaded_file is called.
+        @return: true if the file was queued (only one file can be)
+        """
+        if self.preloaded_path is not None:
+            return self.preloaded_path == path
+
+        self.media_player.Loadfile(path, 1)
+        self.preloaded_path = path
+        return True
+
+    def is_preloaded(self, path):
+        return self.preloaded_path is not None and self.preloaded_path == path
+
+    def play_preloaded_file(self):
+        self.media_player.PtStep(1)
+        self.on_preloaded_file_started()
+        self.is_paused = False
+
+    def on_preloaded_file_started(self):
+        self.playback_state.on_file_loaded()
+        self.current_video_path, self.preloaded_path = self.preloaded_path, None
+
+    def on_output(self, line):
+        self.playback_state.on_output(line)
+
+    def on_media_started(self):
+        self.playback_state.on_started()
+
+    def on_media_finished(self):
+        self.playback_state.on_finished()
+        if self.preloaded_path is not None:
+            # mplayer goes on to the next file of its playlist
+            self.on_preloaded_file_started()
+
     def get_current_video_time_position(self):
-        try:
-            return int(self.media_player.GetTimePos())
-        except (ValueError, TypeError, Queue.Empty):
-            pass
+        return int(self.playback_state.get_position())
 
     def get_current_video_length(self):
-        try:
-            return int(self.media_player.GetTimeLength())
-        except (ValueError, Queue.Empty):
-            return 0
+        length = self.playback_state.get_length()
+        return int(length) if length else 0
 
     def destroy(self):
         self.media_player.Quit()
 
     def play_current_video_at_time_position(self, path, video_time_position):
         self.play_file(path)
-        self.media_player.Seek(video_time_position, type_=2)
\ No newline at end of file
+        self.media_player.Seek(video_time_position, type_=2)
+        self.playback_state.set_position(video_time_position)
@@ -0,0 +1,139 @@
+# coding=utf-8
+import json
+import os
+import threading
+
+
+SIDECAR_SUFFIX = '.ranges'
+
+
+class PartialDownload(object):
+    """
+    An incomplete download: the '.part' file and a sidecar file listing which byte ranges
+    of it have been downloaded. A stopped download keeps both, so that restarting it only
+    downloads the missing bytes (with HTTP Range requests).
+    @param part_path: the path of the '.part' file
+    """
+
+    def __init__(self, part_path):
+        self.part_path = part_path
+        self.sidecar_path = part_path + SIDECAR_SUFFIX
+        self.lock = threading.Lock()
+
+        self.ranges = []
+        self.total_bytes = None
+        self.load()
+
+    def load(self):
+        """
+        Reads the sidecar file, if there is one. A '.part' file without sidecar (for example
+        left by youtube-dl) is taken as downloaded from its first byte.
+        """
+        try:
+            with open(self.sidecar_path) as sidecar:
+                state = json.load(sidecar)
+            self.ranges = [tuple(byte_range) for byte_range in state['ranges']]
+            self.total_bytes = state.get('total_bytes')
+        except (IOError, OSError, ValueError, KeyError):
+            self.ranges = []
+            self.record_file_size()
+
+    def save(self):
+        with self.lock:
+            state = {'ranges': self.ranges, 'total_bytes': self.total_bytes}
+
+        try:
+            with open(self.sidecar_path, 'w') as sidecar:
+                json.dump(state, sidecar)
+        except (IOError, OSError) as e:
+            print("Unable to save the downloaded ranges of %s: %s" % (self.part_path, e))
+
+    def delete(self):
+        """
+        Removes the sidecar, once the download is complete.
+        """
+        try:
+            os.remove(self.sidecar_path)
+        except (IOError, OSError):
+            pass
+
+    def discard(self):
+        """
+        Removes the '.part' file and its sidecar, when their bytes can't be used.
+        """
+        for path in (self.part_path, self.sidecar_path):
+            try:
+                os.remove(path)
+            except (IOError, OSError):
+                pass
+
+    def clear(self):
+        """
+        Forgets every downloaded range, when the file has to be downloaded again from its beginning.
+        """
+        with self.lock:
+            self.ranges = []
+            self.total_bytes = None
+
+    def set_total_bytes(self, total_bytes):
+        if total_bytes:
+            self.total_bytes = int(total_bytes)
+
+    def add_range(self, start, end):
+        """
+        Records that the bytes from start (included) to end (excluded) are on disk.
+        """
+        if end <= start:
+            return
+
+        with self.lock:
+            ranges = sorted(self.ranges + [(start, end)])
+            merged = [ranges[0]]
+            for (range_start, range_end) in ranges[1:]:
+                (last_start, last_end) = merged[-1]
+                if range_start <= last_end:
+                    merged[-1] = (last_start, max(last_end, range_end))
+                else:
+                    merged.append((range_start, range_end))
+            self.ranges = merged
+
+    def record_file_size(self):
+        """
+        Records the bytes of a file written from its beginning, as youtube-dl does.
+        """
+        if os.path.exists(self.part_path):
+            self.add_range(0, os.path.getsize(self.part_path))
+
+    def get_ranges(self):
+        return list(self.ranges)
+
+    def get_downloaded_bytes(self):
+        return sum(end - start for (start, end) in self.ranges)
+
+    def get_contiguous_bytes(self):
+        """
+        @return: the number of bytes that can be read from the beginning of the file without a gap
+        """
+        ranges = self.ranges
+        if ranges and ranges[0][0] == 0:
+            return ranges[0][1]
+        return 0
+
+    def get_missing_ranges(self):
+        """
+        @return: the ranges still to download, as (start, end) tuples. The last one ends
+        with None if the total size is unknown.
+        """
+        missing = []
+        position = 0
+        for (start, end) in self.ranges:
+            if start > position:
+                missing.append((position, start))
+            position = max(position, end)
+
+        if self.total_bytes is None or position < self.total_bytes:
+            missing.append((position, self.total_bytes))
+        return missing
+
+    def is_complete(self):
+        return self.total_bytes is not None and self.get_missing_ranges() == []
@@ -0,0 +1,101 @@
+# coding=utf-8
+import re
+import threading
+import time
+
+
+# The status line mplayer prints while playing (ex: 'A:  12.3 V:  12.3 A-V:  0.000 ...')
+STATUS_LINE = re.compile(r'^\s*(?:A|V):\s*(-?\d+(?:\.\d+)?)')
+# Answers of mplayer to the queries and to -identify (ex: 'ANS_TIME_POSITION=12.3', 'ID_LENGTH=187.00')
+POSITION_ANSWER = re.compile(r'^ANS_TIME_POSITION=(-?\d+(?:\.\d+)?)')
+LENGTH_ANSWER = re.compile(r'^(?:ANS_LENGTH|ID_LENGTH)=(\d+(?:\.\d+)?)')
+
+# The arguments of mplayer for its output to carry the state: MplayerCtrl starts it with
+# '-msglevel all=4', which hides the status line, and without '-identify', which prints ID_LENGTH.
+# Passing arguments replaces the defaults of MplayerCtrl, so they are repeated here
+MPLAYER_ARGS = ['-slave', '-noconsolecontrols', '-nofontconfig', '-idle',
+                '-identify', '-msglevel', 'statusline=5']
+
+
+class PlaybackState(object):
+    """
+    The position and length of the video being played, as the output of mplayer reports them.
+    Between two reports, the position moves on with the clock while the video plays. Reading
+    the state never asks mplayer anything, so it never blocks: the UI can read it on every tick.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.length = None
+        self.position = 0
+        self.updated_at = time.time()
+        self.is_playing = False
+
+    def on_output(self, line):
+        """
+        Updates the state from a line written by mplayer. Other lines are ignored.
+        @param line: the line, without its line break
+        """
+        match = STATUS_LINE.match(line) or POSITION_ANSWER.match(line)
+        if match:
+            self.set_position(float(match.group(1)))
+            return
+
+        match = LENGTH_ANSWER.match(line)
+        if match:
+            with self.lock:
+                self.length = float(match.group(1))
+
+    def on_started(self):
+        with self.lock:
+            self.position = 0
+            self.updated_at = time.time()
+            self.is_playing = True
+
+    def on_finished(self):
+        with self.lock:
+            self.position = self.get_position_now()
+            self.is_playing = False
+
+    def on_file_loaded(self):
+        # The length comes with the output of the new file
+        with self.lock:
+            self.length = None
+            self.position = 0
+            self.updated_at = time.time()
+
+    def pause(self):
+        with self.lock:
+            self.position = self.get_position_now()
+            self.is_playing = False
+
+    def unpause(self):
+        with self.lock:
+            self.updated_at = time.time()
+            self.is_playing = True
+
+    def set_position(self, position):
+        with self.lock:
+            self.position = position
+            self.updated_at = time.time()
+
+    def get_position(self):
+        """
+        @return: the position in the video, in seconds
+        """
+        with self.lock:
+            return self.get_position_now()
+
+    def get_position_now(self):
+        position = self.position
+        if self.is_playing:
+            position += max(0, time.time() - self.updated_at)
+        if self.length:
+            position = min(position, self.length)
+        return position
+
+    def get_length(self):
+        """
+        @return: the length of the video, in seconds (None until mplayer has reported it)
+        """
+        return self.length
@@ -1,23 +1,33 @@
 # coding=utf-8
 import time
+
 import utils
 import wx
 
+from ControlLoop import get_control_loop
 from Downloader import Downloader
-
-
-TIMER_INTERVAL = 0.1
+from PrefetchPolicy import get_prefetch_policy
+from Tracer import get_tracer
+from VideoState import FAILED
 
 
 class PlayerManager(object):
     def __init__(self, media_player, directory=None):
         # Download
         self.downloader = None
+        # The actions of the user run on the control loop, so that the UI never waits for the network
+        self.control_loop = get_control_loop()
+        self.selected_video_index = 0
 
         # Player
         self.length = None
-        self.video_time_position = 0
         self.current_video_index = 0
+        self.traced_video_id = None
+        # Queued in the player after the current video, which plays it without loading it
+        self.preloaded_video = None
+        # How the user leaves the videos decides what is prefetched
+        self.watched_video = None
+        self.prefetch_policy = get_prefetch_policy()
 
         self.directory = utils.make_directory(directory)
         self.media_player = media_player
@@ -26,18 +36,27 @@ class PlayerManager(object):
         self.play_file(path)
 
     def on_media_started(self):
-        self.video_time_position = 0
+        if self.traced_video_id:
+            get_tracer().mark(self.traced_video_id, 'media_started')
+            self.traced_video_id = None
+
         self.length = self.get_current_video_length()
         print("Length of file: %d" % self.length)
 
     def on_media_finished(self):
         self.length = 0
 
+        video, self.preloaded_video = self.preloaded_video, None
+        if video:
+            # The player went on to the preloaded video by itself: the previous one was watched to its end
+            self.record_watched_video(has_ended=True)
+            self.watched_video = video
+            self.traced_video_id = video.video_id
+            self.control_loop.submit(self.advance_to_preloaded_video, self.downloader, video, time.time())
+
     def on_previous(self):
-        is_first_song = self.is_playing_first_song()
-        if not is_first_song:
-            self.start_download(self.current_video_index - 1)
-            self.play_current_video_when_big_enough()
+        self.record_watched_video()
+        self.control_loop.submit(self.select_video_after, -1, time.time())
 
     def on_pause(self):
         self.media_player.pause()
@@ -49,46 +68,139 @@ class PlayerManager(object):
         self.media_player.reset()
 
     def on_next(self):
-        self.start_download(self.current_video_index + 1)
-        self.play_current_video_when_big_enough()
+        self.record_watched_video()
+        self.control_loop.submit(self.select_video_after, 1, time.time())
 
     def on_search(self, search_terms):
-        self.downloader = self.build_downloader(search_terms)
-        self.download_first_video()
-        self.play_current_video_when_big_enough()
+        self.record_watched_video()
+        # The trace of the first video starts with the click, before the feed is fetched
+        self.control_loop.submit(self.search, search_terms, time.time())
 
     def on_timer(self):
         pass
 
-    def must_restart_video(self):
-        is_downloading = self.downloader and self.downloader.is_downloading()
-        return not self.is_video_playing() and is_downloading and self.get_current_video_time_position() > 2
+    def record_watched_video(self, has_ended=False):
+        # Once per video: when the user leaves it, or when the player goes on to the next one
+        video, self.watched_video = self.watched_video, None
+        if video is not None:
+            length = video.get_length()
+            position = length if has_ended else self.media_player.get_current_video_time_position()
+            self.prefetch_policy.record_watched(position, length)
+
+    # Control loop: these steps run one at a time, on the control thread, and never block
 
+    def search(self, search_terms, requested_at):
+        if self.downloader:
+            self.downloader.destroy()
+
+        self.downloader = self.build_downloader(search_terms)
+        self.select_video(0, requested_at)
+
+    def select_video_after(self, offset, requested_at):
+        index = self.selected_video_index + offset
+        if self.downloader and index >= 0:
+            self.select_video(index, requested_at)
+
+    def select_video(self, index, requested_at):
+        """
+        Plays the video with the given index once its page of results is known. A later action
+        supersedes it: pressing next twice only plays the second video.
+        """
+        self.selected_video_index = index
+        downloader = self.downloader
+        downloader.call_when_video_is_known(
+            index, lambda: self.control_loop.submit(self.play_selected_video, downloader, index, requested_at))
+
+    def play_selected_video(self, downloader, index, requested_at):
+        if downloader is not self.downloader or index != self.selected_video_index:
+            # Superseded while its page was fetched
+            return
+
+        if not downloader.has_video(index):
+            print("No more videos")
+            self.selected_video_index = self.current_video_index
+            return
+
+        self.start_download(index, requested_at)
+        self.play_current_video_when_playable()
+
+    def advance_to_preloaded_video(self, downloader, video, requested_at):
+        if downloader is not self.downloader:
+            return
+
+        self.selected_video_index = video.get_index()
+        self.start_download(video.get_index(), requested_at)
+        get_tracer().mark(video.video_id, 'play_file', preloaded=True)
+        downloader.mark_current_video_as_played()
+        self.preload_next_video(downloader, video)
+
+    def preload_next_video(self, downloader, video):
+        """
+        Queues the video after the given one in the player, if it is already being downloaded
+        (it is, when it is in the prefetch window): the player then goes on to it without a pause.
+        """
+        if downloader is not self.downloader or video is not downloader.current_video:
+            return
+
+        next_video = downloader.get_video_after(video)
+        if next_video and (next_video.has_been_downloaded() or next_video.is_downloading):
+            # The player may reach its end: a prefetched head is downloaded to its end too
+            next_video.download()
+            wx.CallAfter(self.preload_video, video, next_video, next_video.get_stream_url())
 
     # Media player
 
     def is_video_playing(self):
         return self.media_player.is_video_playing()
 
-    def play_current_video_when_big_enough(self):
-        self.downloader.wait_while_current_video_is_small()
-        self.play_current_video()
+    def play_current_video_when_playable(self):
+        # The callback comes from the download thread, the player must be used from the UI thread
+        video = self.downloader.current_video
+        self.downloader.call_when_current_video_is_playable(
+            lambda: wx.CallAfter(self.play_video_if_still_current, video))
+
+    def play_video_if_still_current(self, video):
+        # Also called when the download ended without the video: there is nothing to play then
+        if video is not self.downloader.current_video:
+            return
+
+        if video.state.get() == FAILED:
+            self.raise_error_window(video.get_url())
+        elif video.has_file_been_created():
+            self.play_video(video)
+
+    def play_video(self, video):
+        # Plays the video the caller checked, not the current one read again: it may have changed since.
+        # The stream never ends before the download does, so the player doesn't stop at the
+        # end of the downloaded bytes
+        downloader = self.downloader
+        url = video.get_stream_url()
+        self.traced_video_id = video.video_id
+
+        self.watched_video = video
+        is_preloaded = self.preloaded_video is video and self.media_player.is_preloaded(url)
+        get_tracer().mark(self.traced_video_id, 'play_file', preloaded=is_preloaded)
+        if is_preloaded:
+            self.preloaded_video = None
+            self.media_player.play_preloaded_file()
+        else:
+            self.play_file(url)
+        video.mark_as_played()
+        self.control_loop.submit(self.preload_next_video, downloader, video)
 
-    def play_current_video(self):
-        path = self.downloader.get_current_video_file_path()
-        self.play_file(path)
+    def preload_video(self, current_video, video, url):
+        if current_video is self.downloader.current_video and self.media_player.preload_file(url):
+            self.preloaded_video = video
 
     def play_file(self, path):
+        # Loading a file replaces the queue of the player
+        self.preloaded_video = None
         self.media_player.play_file(path)
 
     def raise_error_window(self, path):
         message = "Unable to load %s: Unsupported format?" % path
         wx.MessageBox(message, "ERROR", wx.ICON_ERROR | wx.OK)
 
-    def restart_video(self):
-        path = self.downloader.get_current_video_file_path()
-        self.media_player.play_current_video_at_time_position(path, self.video_time_position)
-
 
     # Downloader
 
@@ -98,10 +210,11 @@ class PlayerManager(object):
     def download_first_video(self):
         self.start_download(0)
 
-    def start_download(self, index):
+    def start_download(self, index, requested_at=None):
+        requested_at = requested_at or time.time()
         self.current_video_index = index
         self.downloader.download_video_with_index(index)
-        time.sleep(2)
+        get_tracer().mark(self.downloader.current_video.video_id, 'play_requested', timestamp=requested_at)
 
 
     # Getters and setters
@@ -110,19 +223,13 @@ class PlayerManager(object):
         return self.current_video_index == 0
 
     def get_current_video_length(self):
-        if self.downloader:
+        if self.downloader and self.downloader.current_video:
             return self.downloader.get_current_video_length()
         else:
             return self.media_player.get_current_video_length()
 
     def get_current_video_time_position(self):
-        return self.media_player.get_current_video_time_position() or self.get_approximate_video_time_position()
-
-    def get_approximate_video_time_position(self):
-        if self.video_time_position:
-            return self.video_time_position + TIMER_INTERVAL
-        else:
-            return 0
+        return self.media_player.get_current_video_time_position()
 
     def get_current_video_file_path(self):
         return self.downloader.get_current_video_file_path()
@@ -130,6 +237,8 @@ class PlayerManager(object):
 
 
     def destroy(self):
+        if self.downloader:
+            self.downloader.destroy()
         self.media_player.destroy()
 
     def is_downloading(self):
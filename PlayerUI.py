@@ -4,6 +4,7 @@ import wx
 
 import MplayerCtrl as mpc
 from MediaPlayer import MediaPlayer
+from PlaybackState import MPLAYER_ARGS
 from PlayerManager import PlayerManager
 import utils
 
@@ -62,7 +63,7 @@ class PlayerUI(wx.Frame):
         playerButtonsSizer = self.make_player_button_sizer()
 
         # Add player and events
-        mplayer_controller = mpc.MplayerCtrl(self.panel, -1, 'mplayer')
+        mplayer_controller = mpc.MplayerCtrl(self.panel, -1, 'mplayer', mplayer_args=MPLAYER_ARGS)
         self.media_player = MediaPlayer(mplayer_controller)
         self.bind_events_to_media_player()
 
@@ -77,6 +78,7 @@ class PlayerUI(wx.Frame):
     def bind_events_to_media_player(self):
         self.panel.Bind(mpc.EVT_MEDIA_STARTED, self.on_media_started)
         self.panel.Bind(mpc.EVT_MEDIA_FINISHED, self.on_media_finished)
+        self.panel.Bind(mpc.EVT_STDOUT, self.on_player_output)
 
     def make_gauge_bar_sizer(self):
         self.gauge_bar = wx.Gauge(self.panel, style=2)
@@ -151,15 +153,20 @@ class PlayerUI(wx.Frame):
         dialog.Destroy()
 
     def on_media_started(self, evt):
+        self.media_player.on_media_started()
         self.update_gauge()
         self.player_manager.on_media_started()
         length = self.player_manager.get_current_video_length()
         print("Length of file: %d" % length)
 
     def on_media_finished(self, evt):
+        self.media_player.on_media_finished()
         self.set_gauge_bar_empty()
         self.player_manager.on_media_finished()
 
+    def on_player_output(self, evt):
+        self.media_player.on_output(evt.data)
+
     def on_exit(self, evt):
         self.media_player.destroy()
         self.player_manager.destroy()
@@ -185,14 +192,6 @@ class PlayerUI(wx.Frame):
         self.player_manager.on_search(search_terms)
 
     def on_timer(self, evt):
-        # todo: if, for some reason (SLOW internet), the media player goes to the end of the file
-        # todo: it will stop and dont try to continue when new contents are ready. Fix this!
-
-        must_restart_video = self.must_restart_video()
-        if must_restart_video:
-            print "Restarting video."
-            self.restart_video()
-
         if self.player_manager.is_video_playing():
             self.video_time_position = self.player_manager.get_current_video_time_position()
             self.update_gauge()
@@ -207,18 +206,6 @@ class PlayerUI(wx.Frame):
     def get_search_terms(self):
         return self.search_terms_input.GetValue().split()
 
-    def restart_video(self):
-        path = self.player_manager.get_current_video_file_path()
-        video_time_position = self.player_manager.get_current_video_time_position()
-        self.media_player.play_current_video_at_time_position(path, video_time_position)
-
-    def must_restart_video(self):
-        is_downloading = self.player_manager.is_downloading()
-        is_video_playing = self.player_manager.is_video_playing()
-        current_time_position = self.player_manager.get_current_video_time_position()
-
-        return not is_video_playing and is_downloading and current_time_position > 2
-
     def raise_error_window(self, path):
         message = "Unable to load %s: Unsupported format?" % path
         wx.MessageBox(message, "ERROR", wx.ICON_ERROR | wx.OK)
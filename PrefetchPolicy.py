@@ -0,0 +1,77 @@
+# coding=utf-8
+import threading
+from collections import deque
+
+
+# A video left before this share of it was played was skipped (like in ystream2)
+SKIP_FRACTION = 0.1
+# The skip rate is measured on the last videos left
+HISTORY_SIZE = 10
+# Above this skip rate, the user is browsing: many heads are prefetched, no whole video
+HIGH_SKIP_RATE = 0.5
+# Below this skip rate, the user watches the videos to their end: only the next one is prefetched
+LOW_SKIP_RATE = 0.2
+
+# Enough for a video to start at once, and to play for a while at the usual bitrates
+HEAD_SIZE = 2 * 1024 * 1024  # 2 MB
+HEAD_WINDOW = 5
+DEFAULT_WINDOW = 2
+
+
+class PrefetchPolicy(object):
+    """
+    Decides what to prefetch after the current video, from how the user left the previous ones.
+    A user who skips most videos gets the first HEAD_SIZE bytes of many of the next ones, so
+    that the next video starts at once without downloading videos that won't be watched. A user
+    who watches videos to their end gets the next one in full. A prefetched head is downloaded
+    to its end when its video is watched.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.skips = deque(maxlen=HISTORY_SIZE)
+
+    def record_watched(self, position, length):
+        """
+        Records that the user left a video (for another one, or because it ended).
+        @param position: the position in the video when it was left, in seconds
+        @param length: the length of the video, in seconds (nothing is recorded if unknown)
+        """
+        if not length:
+            return
+
+        with self.lock:
+            self.skips.append(float(position) / length <= SKIP_FRACTION)
+
+    def get_skip_rate(self):
+        """
+        @return: the share of the last videos that were skipped, or None if no video was left yet
+        """
+        with self.lock:
+            if not self.skips:
+                return None
+            return sum(self.skips) / float(len(self.skips))
+
+    def get_plan(self):
+        """
+        @return: for each of the next videos, the closest first, how many bytes of it to
+        prefetch (None for the whole video)
+        """
+        skip_rate = self.get_skip_rate()
+        if skip_rate is None:
+            return [None] * DEFAULT_WINDOW
+        if skip_rate >= HIGH_SKIP_RATE:
+            return [HEAD_SIZE] * HEAD_WINDOW
+        if skip_rate <= LOW_SKIP_RATE:
+            return [None]
+        return [None] + [HEAD_SIZE] * DEFAULT_WINDOW
+
+
+prefetch_policy = PrefetchPolicy()
+
+
+def get_prefetch_policy():
+    """
+    Returns the policy of the session: how the user watches doesn't change with the search.
+    """
+    return prefetch_policy
@@ -0,0 +1,119 @@
+# coding=utf-8
+import atexit
+import errno
+import os
+import signal
+import subprocess
+import threading
+
+
+# How long a stopped process group may take to exit before it is killed, in seconds
+GRACE_PERIOD = 2.0
+
+
+class ProcessSupervisor(object):
+    """
+    Starts the download processes, each one in its own process group, and tears the whole group
+    down when a download is cancelled: youtube-dl and whatever it started (like ffmpeg). The
+    group is asked to terminate, then killed if it is still there after the grace period.
+    Stopping never waits: the thread that started the process sees it end.
+    @param grace_period: the number of seconds between the request to terminate and the kill
+    """
+
+    def __init__(self, grace_period=GRACE_PERIOD):
+        self.grace_period = grace_period
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.kill_timers = {}
+
+    def start(self, args, **popen_arguments):
+        """
+        Starts a process in a new process group (and session, so that it doesn't get the
+        signals of the terminal).
+        @param args: the command line
+        @param popen_arguments: the other arguments of subprocess.Popen (ex: stdout)
+        @return: the Popen object
+        """
+        process = subprocess.Popen(args, preexec_fn=os.setsid, **popen_arguments)
+        with self.lock:
+            self.processes.add(process)
+        return process
+
+    def wait(self, process):
+        """
+        Waits until the process ends. Once it is reaped, its id may be given to another process
+        (and group): a stopped process isn't killed by its timer anymore.
+        @return: its return code
+        """
+        process.wait()
+        with self.lock:
+            self.processes.discard(process)
+            timer = self.kill_timers.pop(process, None)
+
+            if timer:
+                timer.cancel()
+                # The children it left behind keep the group (and its id) alive until they are killed
+                self.send_signal(process, signal.SIGKILL)
+        return process.returncode
+
+    def stop(self, process):
+        """
+        Asks the process group to terminate, and kills it after the grace period. Returns at once.
+        """
+        timer = threading.Timer(self.grace_period, self.kill, (process,))
+        timer.daemon = True
+        with self.lock:
+            # Already reaped, or already stopped
+            if process not in self.processes or process in self.kill_timers:
+                return
+            # Set before the signals: if the process exits at once, wait() kills what it leaves behind
+            self.kill_timers[process] = timer
+
+            self.send_signal(process, signal.SIGTERM)
+            # A group paused by the bandwidth manager must be resumed to handle the signal
+            self.send_signal(process, signal.SIGCONT)
+        timer.start()
+
+    def kill(self, process):
+        with self.lock:
+            # Not there anymore once the process was reaped: its group may then be another one
+            if self.kill_timers.pop(process, None) is None:
+                return
+
+            if self.send_signal(process, signal.SIGKILL):
+                print("Process %d did not stop within %.1fs: killed" % (process.pid, self.grace_period))
+
+    def kill_all(self):
+        with self.lock:
+            processes = self.processes | set(self.kill_timers)
+            timers = self.kill_timers.values()
+            self.kill_timers = {}
+
+        for timer in timers:
+            timer.cancel()
+        for process in processes:
+            self.send_signal(process, signal.SIGKILL)
+
+    def send_signal(self, process, signal_number):
+        """
+        @return: true if the group still existed
+        """
+        try:
+            # The group has the id of the process that started it
+            os.killpg(process.pid, signal_number)
+            return True
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                print("Unable to signal the process group %d: %s" % (process.pid, e))
+            return False
+
+
+process_supervisor = ProcessSupervisor()
+
+
+def get_process_supervisor():
+    return process_supervisor
+
+
+# The downloads must not outlive the application
+atexit.register(process_supervisor.kill_all)
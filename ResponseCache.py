@@ -0,0 +1,100 @@
+# coding=utf-8
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+DEFAULT_TIME_TO_LIVE = 60 * 60  # 1 hour
+MAX_MEMORY_ENTRIES = 100
+MAX_DISK_ENTRIES = 1000
+
+
+class ResponseCache(object):
+    """
+    Cache of the responses of the Youtube feed, in memory and on disk. Each entry keeps the
+    body of the response, its ETag and Last-Modified headers, and when it was fetched. An entry
+    younger than time_to_live can be used as is; an older one must be revalidated with a
+    conditional request. Both levels are bounded: the least recently used entries are evicted.
+    @param directory: the directory of the on-disk entries
+    @param time_to_live: the number of seconds an entry is used without revalidation
+    @param max_memory_entries: the maximum number of entries in memory
+    @param max_disk_entries: the maximum number of entries on disk
+    """
+
+    def __init__(self, directory, time_to_live=DEFAULT_TIME_TO_LIVE,
+                 max_memory_entries=MAX_MEMORY_ENTRIES, max_disk_entries=MAX_DISK_ENTRIES):
+        self.directory = directory
+        self.time_to_live = time_to_live
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+
+        self.lock = threading.Lock()
+        self.memory_entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the entry of the key (a dictionary with 'body', 'etag', 'last_modified'
+        and 'fetched_at'), or None if there is none.
+        @param key: a tuple identifying the request
+        """
+        with self.lock:
+            entry = self.memory_entries.pop(key, None)
+            if entry is None:
+                entry = self.read_from_disk(key)
+            if entry is not None:
+                self.remember(key, entry)
+            return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.time_to_live
+
+    def put(self, key, body, etag=None, last_modified=None):
+        entry = {'body': body, 'etag': etag, 'last_modified': last_modified, 'fetched_at': time.time()}
+        with self.lock:
+            self.remember(key, entry)
+            self.write_to_disk(key, entry)
+        return entry
+
+    def refresh(self, key, entry):
+        """
+        Marks the entry as fresh again, after the server answered that it has not changed.
+        """
+        return self.put(key, entry['body'], entry['etag'], entry['last_modified'])
+
+    def remember(self, key, entry):
+        self.memory_entries[key] = entry
+        while len(self.memory_entries) > self.max_memory_entries:
+            self.memory_entries.popitem(last=False)
+
+    def get_entry_path(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def read_from_disk(self, key):
+        try:
+            with open(self.get_entry_path(key)) as entry_file:
+                return json.load(entry_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_to_disk(self, key, entry):
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(self.get_entry_path(key), 'w') as entry_file:
+                json.dump(entry, entry_file)
+            self.evict_from_disk()
+        except (IOError, OSError) as e:
+            print("Unable to cache the response: %s" % e)
+
+    def evict_from_disk(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        if len(paths) <= self.max_disk_entries:
+            return
+
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_disk_entries]:
+            os.remove(path)
@@ -0,0 +1,142 @@
+# coding=utf-8
+import threading
+
+
+# The videos this close to the current one are kept whole: the ones being prefetched, and the
+# ones the user is likely to go back to
+RETAINED_VIDEOS = 10
+# Further away, only the metadata of the results is kept, for this many pages on each side.
+# Beyond, the pages are dropped: fetching them again is answered by the feed cache
+RETAINED_PAGES = 10
+
+
+class ResultStore(object):
+    """
+    The results of a search, stored by page as the pages are fetched, in any order: jumping far
+    ahead only needs the page of the video jumped to. Videos are found by index or by id at once.
+    A page only holds the metadata of its results (a compact stub of each video): the Video
+    objects are built when they are first needed, and dropped again when the current video gets
+    far from them, so that the memory of a session doesn't grow with its length.
+    @param page_size: the number of results of each page
+    @param create_video: builds the Video of a result, from its metadata and index
+    """
+
+    def __init__(self, page_size, create_video):
+        self.page_size = page_size
+        self.create_video = create_video
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.videos = {}
+        self.indices_by_id = {}
+        # Past the last result: known exactly once a short page was fetched, else only bounded
+        self.end_index = None
+        self.evicted_pages = 0
+        self.evicted_videos = 0
+
+    def get_page_number(self, index):
+        return index // self.page_size
+
+    def get_first_index(self, page_number):
+        return page_number * self.page_size
+
+    def add_page(self, page_number, metadata):
+        with self.lock:
+            self.pages[page_number] = metadata
+            for (index, video_metadata) in enumerate(metadata, self.get_first_index(page_number)):
+                self.indices_by_id[video_metadata.video_id] = index
+
+            if len(metadata) < self.page_size:
+                end_index = self.get_first_index(page_number) + len(metadata)
+                self.end_index = end_index if self.end_index is None else min(self.end_index, end_index)
+
+    def has_page(self, page_number):
+        return page_number in self.pages
+
+    def get_metadata(self, index):
+        """
+        @return: the metadata of the result with the given index, or None if its page is not
+        fetched (or there is no such result)
+        """
+        page = self.pages.get(self.get_page_number(index))
+        position = index - self.get_first_index(self.get_page_number(index))
+        if index < 0 or page is None or position >= len(page):
+            return None
+        return page[position]
+
+    def get(self, index):
+        """
+        @return: the video with the given index, or None if its page was not fetched (or there is no such video)
+        """
+        with self.lock:
+            video = self.videos.get(index)
+            if video is None:
+                metadata = self.get_metadata(index)
+                if metadata is None:
+                    return None
+                video = self.videos[index] = self.create_video(metadata, index)
+            return video
+
+    def get_by_id(self, video_id):
+        index = self.indices_by_id.get(video_id)
+        if index is None:
+            return None
+        return self.get(index)
+
+    def has(self, index):
+        return self.get_metadata(index) is not None
+
+    def is_known(self, index):
+        """
+        @return: true if the video with the given index is known, or known not to exist
+        """
+        return self.has(index) or self.is_past_end(index) or self.has_page(self.get_page_number(index))
+
+    def is_past_end(self, index):
+        end_index = self.end_index
+        return index < 0 or (end_index is not None and index >= end_index)
+
+    def is_last_page(self, page_number):
+        end_index = self.end_index
+        return end_index is not None and self.get_first_index(page_number + 1) >= end_index
+
+    def get_videos(self):
+        """
+        @return: the videos built and not evicted yet, by index
+        """
+        with self.lock:
+            return [video for (index, video) in sorted(self.videos.items())]
+
+    def retain_around(self, index):
+        """
+        Drops the videos and pages far from the given index (the current video). A video still
+        downloading is kept until its download is stopped.
+        @return: the videos dropped
+        """
+        page_number = self.get_page_number(index)
+        evicted_videos = []
+        with self.lock:
+            for (video_index, video) in self.videos.items():
+                if abs(video_index - index) > RETAINED_VIDEOS and not video.is_downloading:
+                    del self.videos[video_index]
+                    evicted_videos.append(video)
+            self.evicted_videos += len(evicted_videos)
+
+            for (evicted_page_number, metadata) in self.pages.items():
+                if abs(evicted_page_number - page_number) > RETAINED_PAGES:
+                    del self.pages[evicted_page_number]
+                    self.evicted_pages += 1
+                    for video_metadata in metadata:
+                        self.indices_by_id.pop(video_metadata.video_id, None)
+        return evicted_videos
+
+    def get_memory_report(self):
+        """
+        @return: how many pages, results and videos are held, and how many were evicted so far
+        """
+        with self.lock:
+            return {'pages': len(self.pages),
+                    'results': sum(len(metadata) for metadata in self.pages.values()),
+                    'videos': len(self.videos),
+                    'downloading_videos': sum(1 for video in self.videos.values() if video.is_downloading),
+                    'evicted_pages': self.evicted_pages,
+                    'evicted_videos': self.evicted_videos}
@@ -0,0 +1,134 @@
+# coding=utf-8
+import httplib
+import os
+import threading
+import urllib2
+
+
+CONNECTIONS = 4
+SEGMENT_SIZE = 1024 * 1024  # 1 MB
+CHUNK_SIZE = 64 * 1024
+
+
+class SegmentedDownload(object):
+    """
+    Downloads a media url over several connections at once, each one fetching a range of bytes
+    (a segment) into the '.part' file, which is first extended to its full size. The segments
+    are fetched in order: the first missing one, where the playhead is, always comes first, and
+    the end of the file last. The progress counts the bytes downloaded without a gap from the
+    beginning of the file, the only ones the player can read.
+    @param request: the DownloadRequest
+    @param info: the information of the video, with its media 'url'
+    @param partial_download: the PartialDownload of the '.part' file, with its total size
+    @param connections: the number of connections
+    """
+
+    def __init__(self, request, info, partial_download, connections=CONNECTIONS):
+        self.request = request
+        self.info = info
+        self.partial_download = partial_download
+        self.total_bytes = partial_download.total_bytes
+        self.connections = connections
+
+        self.lock = threading.Lock()
+        self.segments = self.get_segments(partial_download.get_missing_ranges())
+        self.errors = []
+
+    def get_segments(self, missing_ranges):
+        segments = []
+        for (start, end) in missing_ranges:
+            end = end or self.total_bytes
+            while start < end:
+                segments.append((start, min(end, start + SEGMENT_SIZE)))
+                start += SEGMENT_SIZE
+        return segments
+
+    def download(self, first_response):
+        """
+        Downloads the missing segments and blocks until they are all done.
+        @param first_response: the response already open at the first missing byte: it gives the
+        first segment, without waiting for a new connection
+        @return: true if the file is complete
+        """
+        self.preallocate()
+        # Taken before the other connections start: the open response is at its first byte
+        first_segment = self.get_next_segment()
+        if first_segment is None:
+            first_response.close()
+
+        workers = []
+        for number in range(1, min(self.connections, len(self.segments) + 1)):
+            worker = threading.Thread(target=self.work, name="segment-download-%d" % number)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        self.work(first_segment, first_response)
+        for worker in workers:
+            worker.join()
+
+        if self.errors:
+            print("Segmented download of %s failed: %s" % (self.request.url, self.errors[0]))
+        return not self.request.is_cancelled and self.partial_download.is_complete()
+
+    def preallocate(self):
+        part_path = self.partial_download.part_path
+        with open(part_path, 'r+b' if os.path.exists(part_path) else 'wb') as part_file:
+            part_file.truncate(self.total_bytes)
+        # Without it, the '.part' file would later be taken as downloaded up to its full size
+        self.partial_download.save()
+
+    def get_next_segment(self):
+        with self.lock:
+            if self.segments and not self.errors:
+                return self.segments.pop(0)
+            return None
+
+    def work(self, segment=None, response=None):
+        if segment is None:
+            segment = self.get_next_segment()
+
+        while segment is not None and not self.request.is_cancelled:
+            try:
+                self.download_segment(segment, response)
+            except (IOError, OSError, httplib.HTTPException) as e:
+                with self.lock:
+                    self.errors.append(e)
+                return
+            finally:
+                if response is not None:
+                    response.close()
+                    response = None
+
+            segment = self.get_next_segment()
+
+    def download_segment(self, segment, response=None):
+        (start, end) = segment
+        if response is None:
+            response = self.open_segment(start, end)
+
+        position = start
+        with open(self.partial_download.part_path, 'r+b') as part_file:
+            part_file.seek(start)
+            while position < end and not self.request.is_cancelled:
+                chunk = response.read(min(CHUNK_SIZE, end - position))
+                if not chunk:
+                    raise IOError("The connection closed at byte %d of the segment %d-%d" % (position, start, end))
+
+                if self.request.rate_limiter:
+                    self.request.rate_limiter.consume(len(chunk))
+
+                part_file.write(chunk)
+                part_file.flush()
+                self.partial_download.add_range(position, position + len(chunk))
+                position += len(chunk)
+                self.request.progress.update(self.partial_download.get_contiguous_bytes(), self.total_bytes)
+
+    def open_segment(self, start, end):
+        media_request = urllib2.Request(self.info['url'], headers=self.info.get('http_headers') or {})
+        media_request.add_header('Range', 'bytes=%d-%d' % (start, end - 1))
+        response = urllib2.urlopen(media_request)
+        if response.getcode() != 206:
+            response.close()
+            raise IOError("The server ignored the range of the segment %d-%d" % (start, end))
+        return response
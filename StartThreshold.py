@@ -0,0 +1,48 @@
+# coding=utf-8
+
+
+# Enough for the player to read the header of the video and decode its first frames
+MIN_START_SIZE = 128 * 1024
+# What is always downloaded ahead of the playhead, in seconds of video
+MIN_BUFFER_SECONDS = 2
+# Only this share of the measured download rate is counted on, since it varies
+RATE_SAFETY_FACTOR = 0.8
+# Waited for when the bitrate or download rate of the video is not known yet
+FALLBACK_SIZE = 256 * 1024
+
+
+class StartThreshold(object):
+    """
+    Decides when a video being downloaded can start playing: as soon as the rest of it will be
+    downloaded before the playhead catches up. A low-bitrate video on a fast link starts almost
+    at once; a high-bitrate video on a slow link waits for the bytes the download can't keep
+    up with. The bitrate comes from the length and size of the video, the download rate from
+    its progress.
+    @param length: the length of the video, in seconds (None if unknown)
+    @param fallback_size: the number of bytes waited for while the decision can't be computed
+    """
+
+    def __init__(self, length, fallback_size=FALLBACK_SIZE):
+        self.length = length
+        self.fallback_size = fallback_size
+
+    def get_required_bytes(self, progress):
+        """
+        @param progress: the DownloadProgress of the video
+        @return: the number of bytes to download before playing
+        """
+        total_bytes = progress.get_total_bytes()
+        download_rate = progress.get_download_rate()
+        if not self.length or not total_bytes or download_rate is None:
+            return min(self.fallback_size, total_bytes or self.fallback_size)
+
+        bitrate = float(total_bytes) / self.length
+        start_size = max(MIN_START_SIZE, bitrate * MIN_BUFFER_SECONDS)
+
+        # Playing from the start, the playhead is at bitrate * t bytes and the download at
+        # downloaded + rate * t. If the download is slower, the gap is the widest at the end.
+        missing_bytes = (bitrate - download_rate * RATE_SAFETY_FACTOR) * self.length
+        return int(min(total_bytes, start_size + max(0, missing_bytes)))
+
+    def is_reached(self, progress):
+        return progress.get_downloaded_bytes() >= self.get_required_bytes(progress)
@@ -0,0 +1,266 @@
+# coding=utf-8
+import BaseHTTPServer
+import mmap
+import os
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+
+
+HOST = '127.0.0.1'
+WAIT_INTERVAL = 0.5
+# How long a request waits for the downloader to announce the size of the video
+TOTAL_SIZE_TIMEOUT = 5
+RANGE_HEADER = re.compile(r'bytes=(?P<start>\d+)-(?P<end>\d*)$')
+
+
+class Stream(object):
+    """
+    A video served by the stream server. While it is downloaded, its bytes are read from the
+    growing '.part' file; once complete, from the final file.
+    @param path: the path of the complete file
+    @param progress: the DownloadProgress of the download, or None if the file is complete
+    """
+
+    def __init__(self, path, progress=None):
+        self.path = path
+        self.progress = progress
+        self.is_closed = False
+
+    def close(self):
+        self.is_closed = True
+
+    def is_complete(self):
+        return self.progress is None or self.progress.has_finished()
+
+    def wait_for_bytes(self, size, timeout=WAIT_INTERVAL):
+        if self.progress is not None:
+            self.progress.wait_until_size(size, timeout)
+
+    def get_available_bytes(self, stream_file):
+        """
+        @return: the number of bytes that can be read from the beginning of the file. While it is
+        downloaded, the file may be longer (a segmented download writes it out of order).
+        """
+        file_size = os.fstat(stream_file.fileno()).st_size
+        if self.is_complete():
+            return file_size
+        return min(file_size, self.progress.get_downloaded_bytes())
+
+    def get_total_bytes(self, stream_file):
+        if self.is_complete():
+            return os.fstat(stream_file.fileno()).st_size
+
+        if self.progress.get_total_bytes() is None:
+            self.progress.wait_until_size(1, TOTAL_SIZE_TIMEOUT)
+        return self.progress.get_total_bytes()
+
+    def open(self):
+        """
+        Opens the file being downloaded, waiting for it to be created. The open file stays valid
+        when the downloader renames it at the end of the download.
+        @return: the open file, or None if the stream was closed or the download ended without it
+        """
+        while not self.is_closed:
+            for path in self.get_candidate_paths():
+                try:
+                    return open(path, 'rb')
+                except IOError:
+                    pass
+
+            if self.is_complete():
+                return None
+            self.wait_for_file()
+
+    def wait_for_file(self):
+        # Once bytes were reported, the progress has no event left for the file: it is polled
+        if self.progress.has_reached(1):
+            time.sleep(WAIT_INTERVAL)
+        else:
+            self.wait_for_bytes(1)
+
+    def get_candidate_paths(self):
+        if self.is_complete():
+            return [self.path]
+
+        # The '.part' file first: the complete one only exists once the download has renamed it
+        paths = [self.path + '.part', self.path]
+        file_path = self.progress.get_file_path()
+        if file_path and file_path not in paths:
+            paths.insert(0, file_path)
+        return paths
+
+
+class StreamRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves a stream over HTTP, with Range requests so that the player can seek. A reader that
+    reaches the bytes not downloaded yet waits for them instead of getting the end of the file.
+    """
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        stream = self.server.get_stream(urllib.unquote(self.path.lstrip('/')))
+        stream_file = stream and stream.open()
+        if stream_file is None:
+            self.send_error(404)
+            return
+
+        try:
+            (start, end) = self.send_stream_headers(stream, stream_file)
+            if send_body and (end is None or start < end):
+                self.send_bytes(stream, stream_file, start, end)
+        except socket.error:
+            # The player closed the connection, for example to seek elsewhere
+            pass
+        finally:
+            stream_file.close()
+
+    def send_stream_headers(self, stream, stream_file):
+        """
+        @return: the range to send, as (start, end). The end is None if the size is unknown.
+        """
+        total_bytes = stream.get_total_bytes(stream_file)
+        byte_range = self.get_requested_range(total_bytes)
+
+        if byte_range is not None and byte_range[0] >= total_bytes:
+            # Starts past the end of the video: nothing to send
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % total_bytes)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return (0, 0)
+
+        if byte_range is None:
+            self.send_response(200)
+            (start, end) = (0, total_bytes)
+        else:
+            self.send_response(206)
+            (start, end) = byte_range
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, total_bytes))
+
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        if end is not None:
+            self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        return (start, end)
+
+    def get_requested_range(self, total_bytes):
+        # Without the total size, a range can't be answered: the whole video is sent instead
+        match = RANGE_HEADER.match(self.headers.getheader('Range', ''))
+        if match is None or total_bytes is None:
+            return None
+
+        start = int(match.group('start'))
+        end = total_bytes
+        if match.group('end'):
+            end = min(int(match.group('end')) + 1, total_bytes)
+        if end <= start < total_bytes:
+            # An invalid range (its end before its start) is ignored
+            return None
+        return (start, end)
+
+    def send_bytes(self, stream, stream_file, start, end):
+        """
+        Sends the bytes from start to end as they are written to the file. The bytes on disk are
+        sent from a memory map of the file, without being copied in this process.
+        """
+        position = start
+        mapped_file = None
+
+        try:
+            while (end is None or position < end) and not stream.is_closed:
+                available = stream.get_available_bytes(stream_file)
+                if end is not None:
+                    available = min(available, end)
+
+                if available > position:
+                    if mapped_file is None or len(mapped_file) < available:
+                        if mapped_file is not None:
+                            mapped_file.close()
+                        mapped_file = mmap.mmap(stream_file.fileno(), available, access=mmap.ACCESS_READ)
+                    self.connection.sendall(buffer(mapped_file, position, available - position))
+                    position = available
+                elif stream.is_complete():
+                    break
+                else:
+                    stream.wait_for_bytes(position + 1)
+        finally:
+            if mapped_file is not None:
+                mapped_file.close()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local HTTP server giving the player a url for each video, readable from its beginning
+    while the video is still downloaded. Runs in its own thread, with a thread per request.
+    @param port: the port to listen on (default: any free port)
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (HOST, port), StreamRequestHandler)
+        self.lock = threading.Lock()
+        self.streams = {}
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, key, path, progress=None):
+        """
+        Makes a video available to the player. Publishing a video again replaces its previous
+        stream (for example when its download was restarted).
+        @param key: the name of the video in the url (ex: its id)
+        @param path: the path of the complete file
+        @param progress: the DownloadProgress of the download, or None if the file is complete
+        @return: the url of the video
+        """
+        with self.lock:
+            previous_stream = self.streams.get(key)
+            if previous_stream is None or previous_stream.path != path or previous_stream.progress is not progress:
+                if previous_stream is not None:
+                    previous_stream.close()
+                self.streams[key] = Stream(path, progress)
+
+        return 'http://%s:%d/%s' % (HOST, self.server_address[1], urllib.quote(key))
+
+    def unpublish(self, key):
+        with self.lock:
+            stream = self.streams.pop(key, None)
+        if stream is not None:
+            stream.close()
+
+    def get_number_of_streams(self):
+        with self.lock:
+            return len(self.streams)
+
+    def get_stream(self, key):
+        with self.lock:
+            return self.streams.get(key)
+
+
+stream_server = None
+stream_server_lock = threading.Lock()
+
+
+def get_stream_server():
+    """
+    Returns the stream server of the application, starting it the first time.
+    """
+    global stream_server
+    with stream_server_lock:
+        if stream_server is None:
+            stream_server = StreamServer()
+        return stream_server
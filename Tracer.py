@@ -0,0 +1,148 @@
+# coding=utf-8
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+MAX_EVENTS = 10000
+# Set to a file path to write the trace there (and print its summary) when the application exits
+TRACE_FILE_VARIABLE = 'YOUSTREAM_TRACE'
+# The stage a user action starts: the following stages of the trace are timed from it
+START_STAGE = 'play_requested'
+
+
+class Tracer(object):
+    """
+    Timestamps the stages each video goes through, from the click to the first frame: feed fetch,
+    metadata parse, path resolution, process spawn, first byte, threshold reached, play_file and
+    media started. Each event belongs to a trace (the id of a video, or of a page of the feed).
+    Recording an event only takes a timestamp and an append; only the last max_events are kept.
+    @param max_events: the maximum number of events kept
+    """
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=max_events)
+
+    def mark(self, trace_id, stage, timestamp=None, **details):
+        """
+        Records that the trace reached a stage.
+        @param trace_id: the id of the trace (ex: the id of the video)
+        @param stage: the name of the stage (ex: 'first_byte')
+        @param timestamp: when the stage was reached (default: now)
+        @param details: anything else worth keeping with the event
+        """
+        event = (trace_id, stage, timestamp or time.time(), None, threading.current_thread().name, details)
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def measure(self, trace_id, stage, **details):
+        """
+        Records a stage that takes time, like fetching the feed: used as a 'with' block.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            event = (trace_id, stage, start, time.time() - start, threading.current_thread().name, details)
+            with self.lock:
+                self.events.append(event)
+
+    def get_events(self):
+        with self.lock:
+            return list(self.events)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+    def get_trace(self):
+        """
+        Returns the events in the Trace Event Format, which chrome://tracing and Perfetto can show.
+        Each trace is shown as its own row.
+        """
+        trace_events = []
+        rows = {}
+        for (trace_id, stage, timestamp, duration, thread_name, details) in self.get_events():
+            trace_event = {'name': stage, 'cat': 'youstream', 'ts': int(timestamp * 1e6), 'pid': os.getpid(),
+                           'tid': rows.setdefault(trace_id, len(rows) + 1),
+                           'args': dict(details, trace_id=trace_id, thread=thread_name)}
+            if duration is None:
+                trace_event.update(ph='i', s='t')
+            else:
+                trace_event.update(ph='X', dur=int(duration * 1e6))
+            trace_events.append(trace_event)
+
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': row, 'args': {'name': trace_id}}
+                    for (trace_id, row) in rows.items()]
+        return {'traceEvents': metadata + trace_events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump(self.get_trace(), trace_file)
+
+    def get_summary(self):
+        """
+        Returns, for each stage, how long after the start of its trace it was reached (and how
+        long it took, for measured stages), as {stage: {'count', 'p50', 'p95', 'duration_p50',
+        'duration_p95'}}. The times are in seconds. A video played again starts a new trace.
+        """
+        offsets = {}
+        durations = {}
+        trace_starts = {}
+        for (trace_id, stage, timestamp, duration, thread_name, details) in sorted(self.get_events(),
+                                                                                   key=lambda event: event[2]):
+            if stage == START_STAGE or trace_id not in trace_starts:
+                trace_starts[trace_id] = timestamp
+
+            offsets.setdefault(stage, []).append(timestamp - trace_starts[trace_id])
+            if duration is not None:
+                durations.setdefault(stage, []).append(duration)
+
+        summary = {}
+        for (stage, stage_offsets) in offsets.items():
+            summary[stage] = {'count': len(stage_offsets),
+                              'p50': get_percentile(stage_offsets, 50),
+                              'p95': get_percentile(stage_offsets, 95)}
+            if stage in durations:
+                summary[stage]['duration_p50'] = get_percentile(durations[stage], 50)
+                summary[stage]['duration_p95'] = get_percentile(durations[stage], 95)
+        return summary
+
+    def print_summary(self):
+        print("%-20s %6s %12s %12s %14s" % ('stage', 'n', 'p50 at (s)', 'p95 at (s)', 'p50 took (s)'))
+        summary = self.get_summary()
+        for stage in sorted(summary, key=lambda stage: summary[stage]['p50']):
+            stage_summary = summary[stage]
+            took = stage_summary.get('duration_p50')
+            print("%-20s %6d %12.3f %12.3f %14s" % (stage, stage_summary['count'], stage_summary['p50'],
+                                                    stage_summary['p95'], '%.3f' % took if took is not None else '-'))
+
+
+def get_percentile(values, percentile):
+    # Nearest rank: always one of the recorded values
+    values = sorted(values)
+    rank = max(0, int(round(percentile / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+tracer = Tracer()
+
+
+def get_tracer():
+    return tracer
+
+
+def export_trace_at_exit():
+    path = os.environ.get(TRACE_FILE_VARIABLE)
+    if path and tracer.get_events():
+        tracer.export(path)
+        tracer.print_summary()
+
+
+atexit.register(export_trace_at_exit)
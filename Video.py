@@ -1,72 +1,83 @@
 # coding=utf-8
+import functools
 import os
-import time
-import subprocess
-
-from multiprocessing.pool import ThreadPool
+import threading
+
+from BandwidthManager import get_shared_bandwidth_manager
+from DownloadBackend import DownloadRequest, get_download_backend
+from DownloadProgress import DownloadProgress
+from DownloadScheduler import get_current_job, get_shared_scheduler, PRIORITY_CURRENT, PRIORITY_PREFETCH
+from FormatSelector import get_format, get_format_selector, MP4_LADDER
+from MediaCache import get_media_cache
+from PartialDownload import PartialDownload
+from SegmentedDownload import CONNECTIONS
+from StartThreshold import StartThreshold
+from StreamServer import get_stream_server
+from Tracer import get_tracer
+from VideoState import VideoState, RESOLVING, DOWNLOADING, PLAYABLE, COMPLETE, CANCELLED, FAILED
 
 
 class Video(object):
-    def __init__(self, metadata_entry, index, directory, max_download_rate=2000):
-        self.author = self.get_author_from_metadata(metadata_entry)
-        self.title = self.get_title_from_metadata(metadata_entry)
-        self.url = self.get_url_from_metadata(metadata_entry)
-        self.date = self.get_date_from_metadata(metadata_entry)
-        self.length = self.get_length_from_metadata(metadata_entry)
+    def __init__(self, metadata, index, directory, max_download_rate=2000):
+        self.metadata = metadata
+        self.author = metadata.author
+        self.title = metadata.title
+        self.url = metadata.url
+        self.date = metadata.date
+        self.length = metadata.length
         self.index = index
-
-        self.is_downloading = False
-        self.pool = None
-        self.download_subprocess = None
+        self.video_id = metadata.video_id
+
+        # The state of the download and the path of the file: any thread may change them
+        self.state = VideoState(self.video_id)
+        # Held while a download is started, stopped or closed
+        self.lock = threading.RLock()
+        self.scheduler = get_shared_scheduler()
+        self.download_job = None
+        self.download_backend = get_download_backend()
+        self.download_request = None
+        self.progress = None
+        self.partial_download = None
+        self.bandwidth_manager = get_shared_bandwidth_manager()
+        self.rate_limiter = None
         self.max_download_rate = max_download_rate
         self.is_prefetching = False
-        self.is_downloaded = False
+        self.prefetch_distance = 0
+        # Set when the whole video is asked for after its head was complete, but not closed yet
+        self.is_full_download_pending = False
+        self.format_selector = get_format_selector()
+        self.quality = None
 
         self.directory = directory
-        self.file_path = None
-
-    def get_author_from_metadata(self, metadata_entry):
-        return self.try_to_get_attribute(metadata_entry, 'author', 0, 'name', '$t')
-
-    def get_title_from_metadata(self, metadata_entry):
-        return self.try_to_get_attribute(metadata_entry, 'media$group', 'media$title', '$t')
-
-    def get_url_from_metadata(self, metadata_entry):
-        return self.try_to_get_attribute(metadata_entry, 'link', 0, 'href')
+        self.media_cache = get_media_cache(directory)
 
-    def get_date_from_metadata(self, metadata_entry):
-        return self.try_to_get_attribute(metadata_entry, 'updated', '$t')
+    @property
+    def is_downloading(self):
+        return self.state.is_active()
 
-    def get_length_from_metadata(self, metadata_entry):
-        length = self.try_to_get_attribute(metadata_entry, 'media$group', 'yt$duration', 'seconds')
-        if length:
-            return int(length)
+    @property
+    def is_downloaded(self):
+        return self.state.is_complete()
 
-        length = self.try_to_get_attribute(metadata_entry, 'media$group', 'media$content', 0, 'duration')
-        if length:
-            return int(length)
+    @property
+    def file_path(self):
+        return self.state.get_file_path()
 
-    def try_to_get_attribute(self, entry, *args):
+    def set_prefetching(self, distance=1):
         """
-        Given various attributes, tries extract them from the entry.
-        Example: try_to_get_attribute(entry, 'data', 'result', 'length') tries
-        to return entry['data']['result']['length']. Simple method to handle the
-        necessary exception handling behind the scenes. If there is an error,
-        None is returned.
+        Marks the video as prefetched, distance videos after the current one. The further
+        the video, the later its download starts.
         """
-        try:
-            result = entry
-            for arg in args:
-                result = result[arg]
-            return result
-        except AttributeError:
-            return None
-
-    def set_prefetching(self):
         self.is_prefetching = True
+        self.prefetch_distance = distance
+        self.update_download_priority()
+        self.update_rate_limiter()
 
     def set_full_download_speed(self):
         self.is_prefetching = False
+        self.prefetch_distance = 0
+        self.update_download_priority()
+        self.update_rate_limiter()
 
     def get_index(self):
         return self.index
@@ -82,48 +93,196 @@ class Video(object):
 
     def get_file_path(self):
         self.check_download_has_started()
+        if self.is_downloading and self.progress.get_file_path():
+            return self.progress.get_file_path()
         return self.file_path
 
+    def get_stream_url(self):
+        """
+        Returns the url of the video on the local stream server. The player can read it from its
+        beginning while the video is still downloaded: it waits for the missing bytes instead of
+        reaching the end of the file.
+        """
+        self.check_download_has_started()
+        if self.is_downloaded:
+            return get_stream_server().publish(self.video_id, self.file_path)
+        return get_stream_server().publish(self.video_id, self.get_finished_file_path(), self.progress)
+
     def get_file_size(self):
         self.check_download_has_started()
         return (os.path.exists(self.file_path) and os.path.getsize(self.file_path)) or 0
 
     def has_been_downloaded(self):
+        if not self.is_downloaded and not self.is_downloading:
+            self.load_from_cache()
         return self.is_downloaded
 
-    def has_file_been_created(self):
-        return self.is_downloading or self.is_downloaded
-
-    def download(self):
-        if not self.is_downloaded:
-            self.start_download()
-
-    def start_download(self):
-        self.is_downloading = True
-        self.pool = ThreadPool(processes=1)
-        self.pool.apply_async(self.download_video, callback=self.close_subprocess)
-        self.pool.close()
+    def load_from_cache(self):
+        # A video downloaded earlier, in this session or a previous one, needs no network
+        cached_path = self.media_cache.get_path(self.video_id)
+        if cached_path:
+            self.state.transition(COMPLETE, file_path=cached_path)
 
-        # Allow some time for youtube-dl to start
-        time.sleep(1)
+    def mark_as_played(self):
+        self.media_cache.mark_as_played(self.video_id)
 
-    def download_video(self):
-        self.file_path = self.get_incomplete_file_path()
-        print("Got path:", self.file_path)
-
-        print("Starting download process")
-        self.start_download_subprocess()
-        print("Process started. Waiting!")
-        self.download_subprocess.wait()
-        print("Wait is over. Download ended")
+    def has_file_been_created(self):
+        return self.is_downloading or self.is_downloaded
 
-    def get_incomplete_file_path(self):
-        return self.get_finished_file_path() + '.part'
+    def download(self, max_bytes=None):
+        """
+        Downloads the video, or only its first max_bytes bytes (its head). Called again without
+        max_bytes, it downloads the rest.
+        """
+        if self.has_been_downloaded():
+            return
+
+        with self.lock:
+            request = self.download_request
+            if not self.is_downloading:
+                self.start_download(max_bytes)
+            elif max_bytes is None and request and not request.remove_max_bytes():
+                # Its head is complete: the rest is downloaded once the head download is closed
+                self.is_full_download_pending = True
+
+    def start_download(self, max_bytes=None):
+        # Called while holding the lock
+        # A stopped download is resumed in its own quality: only a fresh one gets a new quality
+        self.quality = self.find_partial_download_quality() or \
+            self.format_selector.select(self.length, is_prefetching=self.is_prefetching)
+        self.discard_other_partial_downloads()
+
+        # The progress is set before the state changes, so that callers can wait on the file right away
+        file_path = self.get_incomplete_file_path()
+        self.progress = DownloadProgress(file_path)
+        self.resume_partial_download(file_path)
+        if max_bytes and self.progress.get_downloaded_bytes() >= max_bytes:
+            # Its head is already on disk
+            return
+
+        request = DownloadRequest(self.url, self.get_output_file_template(), get_format(self.quality),
+                                  self.progress, self.get_download_rate_ceiling(),
+                                  self.partial_download, trace_id=self.video_id,
+                                  connections=self.get_download_connections(), max_bytes=max_bytes)
+        download_number = self.state.start(file_path)
+        if download_number is None:
+            return
+
+        self.download_request = request
+        get_tracer().mark(self.video_id, 'download_queued', prefetch=self.is_prefetching, quality=self.quality.name)
+
+        self.download_job = self.scheduler.submit(self.download_video, args=(request, download_number, self.quality),
+                                                  priority=self.get_download_priority(),
+                                                  callback=functools.partial(self.close_download, download_number),
+                                                  on_cancel=request.cancel)
+
+    def get_download_connections(self):
+        # The video being watched fills the link faster over several connections; the prefetched
+        # ones don't need to
+        if self.is_prefetching:
+            return 1
+        return CONNECTIONS
 
-    def get_finished_file_path(self):
-        title = self.get_title()
-        path = "%s%s.mp4" % (self.directory, title)
-        return path.replace("\"", "'")
+    def get_download_priority(self):
+        if self.is_prefetching:
+            return PRIORITY_PREFETCH + self.prefetch_distance
+        else:
+            return PRIORITY_CURRENT
+
+    def update_download_priority(self):
+        if self.download_job:
+            self.scheduler.change_priority(self.download_job, self.get_download_priority())
+
+    def update_rate_limiter(self):
+        # Changes the share of bandwidth of a running download, without restarting it
+        rate_limiter = self.rate_limiter
+        if rate_limiter:
+            rate_limiter.set_foreground(not self.is_prefetching)
+
+    def download_video(self, request, download_number, quality):
+        # Everything of this download is passed along: once it is stopped, the video may start another one
+        progress = request.progress
+        print("Got path:", progress.get_file_path())
+
+        get_tracer().mark(self.video_id, 'download_started')
+        self.state.transition(RESOLVING, download_number)
+        self.follow_progress(progress, download_number)
+
+        rate_limiter = self.rate_limiter = self.bandwidth_manager.open_stream(is_foreground=not self.is_prefetching)
+        request.rate_limiter = rate_limiter
+        if get_current_job().was_cancelled():
+            # Cancelled before the download started
+            request.cancel()
+
+        print("Starting download with the %s backend" % self.download_backend.name)
+        try:
+            is_complete = self.download_backend.download(request)
+        finally:
+            self.close_rate_limiter(rate_limiter)
+            self.report_download_rate(quality, progress)
+        print("Download ended")
+
+        if not is_complete and not request.is_cancelled:
+            self.state.transition(FAILED, download_number)
+            progress.finish()
+            raise IOError("The download of %s failed" % self.url)
+        return is_complete
+
+    def follow_progress(self, progress, download_number):
+        # The callbacks are also called when the download ends: only the bytes on disk count
+        threshold = StartThreshold(self.length)
+
+        def on_first_byte():
+            if progress.get_downloaded_bytes() > 0:
+                self.state.transition(DOWNLOADING, download_number)
+
+        def on_playable():
+            if threshold.is_reached(progress) and not progress.has_finished():
+                self.state.transition(PLAYABLE, download_number)
+
+        progress.call_when_size_reached(1, on_first_byte)
+        progress.call_when(threshold.is_reached, on_playable)
+
+    def resume_partial_download(self, file_path):
+        # The bytes kept from a previous, stopped download are already playable
+        self.partial_download = PartialDownload(file_path)
+        already_downloaded_bytes = self.partial_download.get_contiguous_bytes()
+        if already_downloaded_bytes:
+            print("Resuming download at byte %d" % already_downloaded_bytes)
+            self.progress.update(already_downloaded_bytes, self.partial_download.total_bytes)
+
+    def report_download_rate(self, quality, progress):
+        # Prefetches only get a share of the bandwidth: they say little about the link
+        if not self.is_prefetching:
+            kept_ahead = self.format_selector.report(quality, progress.get_download_rate())
+            if not kept_ahead:
+                print("The download of %s fell behind playback in %s quality" % (self.video_id, quality.name))
+
+    def find_partial_download_quality(self):
+        """
+        @return: the quality of the bytes kept from a stopped download (the most of them), or
+        None if there are none
+        """
+        downloaded_bytes = dict((quality, PartialDownload(self.get_incomplete_file_path(quality)).get_downloaded_bytes())
+                                for quality in MP4_LADDER)
+        quality = max(MP4_LADDER, key=downloaded_bytes.get)
+        if downloaded_bytes[quality]:
+            return quality
+        return None
+
+    def discard_other_partial_downloads(self):
+        # The bytes of another quality can't be resumed in this one
+        for quality in MP4_LADDER:
+            if quality is not self.quality:
+                PartialDownload(self.get_incomplete_file_path(quality)).discard()
+
+    def get_incomplete_file_path(self, quality=None):
+        return self.get_finished_file_path(quality) + '.part'
+
+    def get_finished_file_path(self, quality=None):
+        # Named after the id and quality of the video, so that the path is known before youtube-dl starts
+        quality = quality or self.quality
+        return "%s%s.%s.mp4" % (self.directory, self.video_id, quality.name)
 
     def get_title(self):
         if self.title[-1] == '*':
@@ -131,57 +290,94 @@ class Video(object):
         else:
             return self.title
 
-    def start_download_subprocess(self):
-        args = self.get_download_process_arguments()
-        self.download_subprocess = subprocess.Popen(args)
-
-    def get_download_process_arguments(self):
-        args = ["youtube-dl"]
-        args.extend(['--output', self.get_output_file_template()])
-        args.extend(['-f', 'mp4'])
-        args.extend(['-r', self.get_download_rate_param()])
-        args.append(self.url)
-        return args
-
     def get_output_file_template(self):
-        return self.directory + '%(title)s.mp4'
-
-    def get_download_rate_param(self):
-        if self.is_prefetching:
-            return "%dk" % self.max_download_rate
-        else:
-            return "%dk" % (self.max_download_rate // 2)
+        return self.get_finished_file_path()
+
+    def get_download_rate_ceiling(self):
+        # Only a ceiling: the actual rate is set by the bandwidth manager while downloading
+        return min(self.max_download_rate, self.bandwidth_manager.get_total_rate())
+
+    def close_rate_limiter(self, rate_limiter):
+        if self.rate_limiter is rate_limiter:
+            self.rate_limiter = None
+        rate_limiter.close()
+
+    def close_download(self, download_number, is_complete):
+        with self.lock:
+            progress = self.progress
+            if not is_complete:
+                is_closed = self.close_head_download(download_number)
+            else:
+                is_closed = self.state.transition(COMPLETE, download_number, self.get_finished_file_path())
+                if is_closed:
+                    self.media_cache.add(self.video_id, self.file_path, self.quality.name)
+                    self.download_request = None
+                    self.download_job = None
+
+        if is_closed:
+            # Outside of the lock: the callbacks of the waiters may use the video
+            progress.finish()
+
+    def close_head_download(self, download_number):
+        """
+        Ends a download stopped at the end of the head of the video. The rest is downloaded when
+        the video is watched: at once if it became the current video in the meantime, or if the
+        whole video was asked for while the head was closing. Called while holding the lock.
+        @return: true if the download was still running
+        """
+        if not self.state.transition(CANCELLED, download_number):
+            return False
 
-    def close_subprocess(self, callback_arg):
-        # Callback argument is useless, but is passed by apply_assync function
-        # And so we keep it to prevent errors
-        self.is_downloading = False
-        self.is_downloaded = True
+        self.download_request = None
+        self.download_job = None
 
-        self.file_path = self.get_finished_file_path()
+        is_full_download_pending, self.is_full_download_pending = self.is_full_download_pending, False
+        if is_full_download_pending or not self.is_prefetching:
+            self.start_download()
 
-        self.download_subprocess = None
-        self.pool = None
+        stream_server = get_stream_server()
+        if self.is_downloading and stream_server.get_stream(self.video_id):
+            # Under the same url: the player may have queued it
+            stream_server.publish(self.video_id, self.get_finished_file_path(), self.progress)
+        else:
+            stream_server.unpublish(self.video_id)
+        # Whoever waits on the head is woken up once it returns: the ones waiting to play get the new download
+        return True
 
     def stop_downloading(self):
-        if self.pool:
-            self.pool.terminate()
-
-    def wait_while_file_is_small(self, size):
+        with self.lock:
+            job = self.download_job
+            if job is None or not self.state.transition(CANCELLED):
+                return
+            progress = self.progress
+            self.is_full_download_pending = False
+            self.download_request = None
+            self.download_job = None
+
+        job.cancel()
+        # Its readers and waiters would otherwise wait for bytes that will never come: the callback
+        # of a cancelled job, which finishes the progress, is not called
+        get_stream_server().unpublish(self.video_id)
+        progress.finish()
+
+    def call_when_playable(self, callback):
+        """
+        Calls the callback as soon as the video can play to its end without catching up with
+        the download (or the download has ended), without blocking the calling thread. How much
+        is needed depends on the bitrate of the video and on how fast it downloads.
+        """
         self.check_download_has_started()
-        self.wait_while_file_is_smaller_than(size)
+        threshold = StartThreshold(self.length)
 
-    def wait_while_file_is_smaller_than(self, size, interval=0.2):
-        print "Required size: %d " % size
-        while self.is_file_is_too_small(size):
-            print "Actual size : %d " % (os.path.exists(self.file_path) and os.path.getsize(self.file_path))
-            time.sleep(interval)
+        def on_playable():
+            get_tracer().mark(self.video_id, 'threshold_reached', size=self.progress.get_downloaded_bytes())
+            callback()
 
-    def is_file_is_too_small(self, size):
-        return not self.is_downloaded and not self.is_file_size_greater_than(self.file_path, size)
-
-    def is_file_size_greater_than(self, path, size):
-        return os.path.exists(path) and os.path.getsize(path) > size
+        if self.is_downloaded:
+            get_tracer().mark(self.video_id, 'threshold_reached', cached=True)
+            callback()
+        else:
+            self.progress.call_when(threshold.is_reached, on_playable)
 
     def check_download_has_started(self):
         if not (self.is_downloaded or self.is_downloading):
@@ -0,0 +1,20 @@
+# coding=utf-8
+
+
+class VideoMetadata(object):
+    """
+    The metadata of a search result that the application uses, and nothing else.
+    Built from the entries of the Youtube feed by utils.get_metadata_from_entry.
+    """
+    __slots__ = ('video_id', 'author', 'title', 'url', 'date', 'length')
+
+    def __init__(self, video_id, author, title, url, date, length):
+        self.video_id = video_id
+        self.author = author
+        self.title = title
+        self.url = url
+        self.date = date
+        self.length = length
+
+    def __repr__(self):
+        return "VideoMetadata(%r, %r)" % (self.video_id, self.title)
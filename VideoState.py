@@ -0,0 +1,144 @@
+# coding=utf-8
+import threading
+import time
+
+from Tracer import get_tracer
+
+
+NEW = 'new'
+# Waiting for a free download slot
+QUEUED = 'queued'
+# The download started, nothing arrived yet: youtube-dl resolves the media url
+RESOLVING = 'resolving'
+DOWNLOADING = 'downloading'
+# Enough has arrived for the video to play to its end without catching up with the download
+PLAYABLE = 'playable'
+COMPLETE = 'complete'
+# Stopped before its end: by the user, or at the end of its head. It resumes when downloaded again
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+TRANSITIONS = {NEW: (QUEUED, COMPLETE),
+               QUEUED: (RESOLVING, CANCELLED),
+               RESOLVING: (DOWNLOADING, PLAYABLE, COMPLETE, CANCELLED, FAILED),
+               DOWNLOADING: (PLAYABLE, COMPLETE, CANCELLED, FAILED),
+               PLAYABLE: (COMPLETE, CANCELLED, FAILED),
+               COMPLETE: (),
+               CANCELLED: (QUEUED, COMPLETE),
+               FAILED: (QUEUED, COMPLETE)}
+
+ACTIVE_STATES = (QUEUED, RESOLVING, DOWNLOADING, PLAYABLE)
+
+
+class VideoState(object):
+    """
+    The state of the download of a video, and the path of its file, changed by any thread and
+    read by any other. Only the transitions of TRANSITIONS are made: the others are refused, so
+    that a late event (like the first byte of a download cancelled in the meantime) can't undo a
+    newer one. Each download gets a number: the events of a previous download of the video are
+    refused too. Each transition is traced, and given to the listeners.
+    @param video_id: the id of the video
+    """
+
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.condition = threading.Condition()
+        self.state = NEW
+        self.file_path = None
+        self.download_number = 0
+        self.listeners = []
+
+    def get(self):
+        return self.state
+
+    def get_file_path(self):
+        return self.file_path
+
+    def is_active(self):
+        return self.state in ACTIVE_STATES
+
+    def is_complete(self):
+        return self.state == COMPLETE
+
+    def add_listener(self, listener):
+        """
+        @param listener: called (from the thread making the transition) with the id of the video,
+        the previous state and the new one
+        """
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def start(self, file_path):
+        """
+        Queues a new download of the video, unless one is already running or the video is complete.
+        @param file_path: the path of the file the download writes
+        @return: the number of the download, or None if it was refused
+        """
+        with self.condition:
+            previous_state = self.change(QUEUED, file_path)
+            if previous_state is None:
+                return None
+            self.download_number += 1
+            download_number = self.download_number
+        self.notify(previous_state, QUEUED)
+        return download_number
+
+    def transition(self, state, download_number=None, file_path=None):
+        """
+        Moves to the given state, if it can be reached from the current one.
+        @param state: the new state
+        @param download_number: the download the transition belongs to (default: any)
+        @param file_path: the new path of the file, if it changes
+        @return: true if the transition was made
+        """
+        with self.condition:
+            if download_number is not None and download_number != self.download_number:
+                return False
+            previous_state = self.change(state, file_path)
+            if previous_state is None:
+                return False
+        self.notify(previous_state, state)
+        return True
+
+    def change(self, state, file_path):
+        # Called while holding the lock. Returns the previous state, or None if the transition is refused
+        previous_state = self.state
+        if state not in TRANSITIONS[previous_state]:
+            return None
+
+        self.state = state
+        if file_path is not None:
+            self.file_path = file_path
+        self.condition.notify_all()
+        return previous_state
+
+    def notify(self, previous_state, state):
+        get_tracer().mark(self.video_id, 'state_changed', previous_state=previous_state, state=state)
+        with self.condition:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(self.video_id, previous_state, state)
+
+    def wait_until(self, states, timeout=None):
+        """
+        Blocks until the video is in one of the given states.
+        @param states: the states
+        @param timeout: the maximum number of seconds to wait (default: no limit)
+        @return: true if the video is in one of the states, false on timeout
+        """
+        deadline = timeout is not None and time.time() + timeout
+
+        with self.condition:
+            while self.state not in states:
+                remaining = None
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.condition.wait(remaining)
+            return True
@@ -0,0 +1,75 @@
+# coding=utf-8
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+DEFAULT_NUMBER_OF_RESULTS = 50
+DEFAULT_LATENCY = 0.05
+VIDEO_LENGTH = 200
+
+
+class FakeFeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for the Youtube gdata feed (utils.YOUTUBE_URL). Answers every search with
+    the same made-up results, so that benchmarks are reproducible and need no network.
+    @param number_of_results: the number of results of every search
+    @param latency: the number of seconds before each response
+    """
+    daemon_threads = True
+
+    def __init__(self, number_of_results=DEFAULT_NUMBER_OF_RESULTS, latency=DEFAULT_LATENCY):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeFeedRequestHandler)
+        self.number_of_results = number_of_results
+        self.latency = latency
+        self.number_of_requests = 0
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_feed_url_template(self):
+        """
+        @return: the url template to use as utils.YOUTUBE_URL
+        """
+        return 'http://127.0.0.1:%d/feeds/api/videos?q=%%s&alt=json&start_index=%%d&max-results=%%d' \
+               % self.server_address[1]
+
+    def get_feed(self, search_terms, start_index, max_results):
+        # Youtube counts the results from 1
+        last_index = min(start_index - 1 + max_results, self.number_of_results)
+        entries = [self.get_entry(search_terms, index) for index in range(start_index - 1, last_index)]
+        return {'feed': {'entry': entries}} if entries else {'feed': {}}
+
+    def get_entry(self, search_terms, index):
+        video_id = 'bench%s%03d' % (search_terms.replace('+', ''), index)
+        return {'author': [{'name': {'$t': 'benchmark'}}],
+                'media$group': {'media$title': {'$t': 'Video %d' % index},
+                                'yt$duration': {'seconds': str(VIDEO_LENGTH)}},
+                'link': [{'href': 'https://www.youtube.com/watch?v=%s' % video_id}],
+                'updated': {'$t': '2014-01-01T00:00:00.000Z'}}
+
+
+class FakeFeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        search_terms = query.get('q', [''])[0]
+        start_index = int(query.get('start_index', ['1'])[0])
+        max_results = int(query.get('max-results', ['10'])[0])
+
+        self.server.number_of_requests += 1
+        time.sleep(self.server.latency)
+
+        body = json.dumps(self.server.get_feed(search_terms, start_index, max_results))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,120 @@
+# coding=utf-8
+"""
+A stand-in for youtube-dl, used by the benchmarks. It understands the options the application
+passes (-o/--output, -f, -r, --continue, --http-chunk-size, --newline), writes a file of made-up
+bytes at a configurable bandwidth and prints the same progress lines as youtube-dl. Like
+youtube-dl, it downloads in requests of --http-chunk-size bytes, each one waiting for the latency.
+
+Configured with environment variables:
+FAKE_YOUTUBE_DL_BANDWIDTH: the download rate, in KiB/s (default: 4000)
+FAKE_YOUTUBE_DL_LATENCY: the number of seconds before the download starts (default: 0.2)
+FAKE_YOUTUBE_DL_SIZE: the size of every video, in bytes (default: 4 MiB)
+"""
+import os
+import sys
+import time
+import urlparse
+
+
+CHUNK_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 0.1
+UNITS = {'k': 1024, 'K': 1024, 'm': 1024 ** 2, 'M': 1024 ** 2}
+
+
+def get_option(args, names, default=None):
+    for name in names:
+        if name in args:
+            return args[args.index(name) + 1]
+    return default
+
+
+def get_rate_limit(args):
+    rate = get_option(args, ['-r', '--rate-limit'])
+    if rate is None:
+        return None
+    if rate[-1] in UNITS:
+        return float(rate[:-1]) * UNITS[rate[-1]]
+    return float(rate)
+
+
+def get_video_id(url):
+    query = urlparse.parse_qs(urlparse.urlparse(url).query)
+    return query.get('v', ['video'])[0]
+
+
+def print_line(line):
+    print line
+    sys.stdout.flush()
+
+
+def print_progress(downloaded_bytes, total_bytes, rate):
+    print_line("[download] %5.1f%% of %.2fMiB at %.2fKiB/s ETA 00:00"
+               % (downloaded_bytes * 100.0 / total_bytes, total_bytes / 1024.0 ** 2, rate / 1024.0))
+
+
+def download(url, template, video_format, rate, total_bytes, latency, resume, chunk_size):
+    video_id = get_video_id(url)
+    # The first format asked for is always available
+    format_id = video_format.split('/')[0]
+    path = template % {'id': video_id, 'title': video_id, 'ext': 'mp4', 'format_id': format_id}
+    part_path = path + '.part'
+
+    time.sleep(latency)
+    if os.path.exists(path):
+        print_line("[download] %s has already been downloaded" % path)
+        return
+
+    downloaded_bytes = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+    if downloaded_bytes:
+        print_line("[download] Resuming download at byte %d" % downloaded_bytes)
+    # Like youtube-dl, names the complete file while it writes the '.part' one
+    print_line("[download] Destination: %s" % path)
+
+    chunk = 'x' * CHUNK_SIZE
+    start = time.time()
+    last_progress = 0
+    with open(part_path, 'ab' if downloaded_bytes else 'wb') as part_file:
+        written_bytes = 0
+        request_end = downloaded_bytes + chunk_size if chunk_size else total_bytes
+        while downloaded_bytes < total_bytes:
+            if downloaded_bytes >= request_end:
+                # The next request for a chunk
+                time.sleep(latency)
+                start += latency
+                request_end += chunk_size
+
+            size = min(CHUNK_SIZE, total_bytes - downloaded_bytes, request_end - downloaded_bytes)
+            part_file.write(chunk[:size])
+            part_file.flush()
+            downloaded_bytes += size
+            written_bytes += size
+
+            # Sleeps until the average rate is back to the limit
+            delay = start + float(written_bytes) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            if time.time() - last_progress >= PROGRESS_INTERVAL or downloaded_bytes in (total_bytes, request_end):
+                last_progress = time.time()
+                print_progress(downloaded_bytes, total_bytes, rate)
+
+    os.rename(part_path, path)
+
+
+def main(args):
+    bandwidth = float(os.environ.get('FAKE_YOUTUBE_DL_BANDWIDTH', 4000)) * 1024
+    latency = float(os.environ.get('FAKE_YOUTUBE_DL_LATENCY', 0.2))
+    total_bytes = int(os.environ.get('FAKE_YOUTUBE_DL_SIZE', 4 * 1024 ** 2))
+
+    rate_limit = get_rate_limit(args)
+    rate = min(bandwidth, rate_limit) if rate_limit else bandwidth
+    template = get_option(args, ['-o', '--output'], '%(title)s-%(id)s.%(ext)s')
+    video_format = get_option(args, ['-f', '--format'], 'best')
+    chunk_size = int(get_option(args, ['--http-chunk-size'], 0))
+
+    download(args[-1], template, video_format, rate, total_bytes, latency, '--continue' in args or '-c' in args,
+             chunk_size)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,359 @@
+# coding=utf-8
+"""
+End-to-end latency benchmarks, run headlessly against a local fake of the Youtube feed and
+a fake youtube-dl, so that they are reproducible and need no network.
+
+For each player (Downloader/Video, the legacy downloader.Downloader and ystream2.Player), measures
+how long it takes from a search, a 'next' or a 'previous' until the video can be played, and
+the CPU time and number of threads used.
+
+Usage: python2 benchmarks/run_benchmarks.py [--runs 5] [--json results.json] [--trace trace.json] [--max-p95 3]
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIRECTORY))
+
+import DownloadBackend
+import downloader as legacy_downloader
+import utils
+from BandwidthManager import get_shared_bandwidth_manager
+from Downloader import Downloader
+from ResponseCache import ResponseCache
+from Tracer import get_percentile, get_tracer
+from fake_feed_server import FakeFeedServer
+
+
+# What the player reads before showing the first frame
+FIRST_FRAME_SIZE = 64 * 1024
+# What the legacy downloader waits for while the bitrate of the song is unknown
+LEGACY_FALLBACK_SIZE = 256 * 1024
+PLAYABLE_TIMEOUT = 60
+SAMPLING_INTERVAL = 0.01
+
+
+class ResourceMonitor(object):
+    """
+    Measures the CPU time used by this process and its (waited for) children, and the maximum
+    number of threads alive, while it runs.
+    """
+
+    def __init__(self):
+        self.max_threads = 0
+        self.is_running = False
+        self.thread = None
+        self.start_usage = None
+
+    def start(self):
+        self.start_usage = self.get_cpu_times()
+        self.is_running = True
+        self.thread = threading.Thread(target=self.sample_threads)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        self.thread.join()
+        (process_time, children_time) = self.get_cpu_times()
+        return {'cpu_seconds': process_time - self.start_usage[0],
+                'children_cpu_seconds': children_time - self.start_usage[1],
+                'max_threads': self.max_threads}
+
+    def sample_threads(self):
+        while self.is_running:
+            # This thread is not counted
+            self.max_threads = max(self.max_threads, threading.active_count() - 1)
+            time.sleep(SAMPLING_INTERVAL)
+
+    def get_cpu_times(self):
+        process_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (process_usage.ru_utime + process_usage.ru_stime,
+                children_usage.ru_utime + children_usage.ru_stime)
+
+
+class Timings(object):
+    """
+    The measured durations of each kind of action (ex: 'next_to_play').
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+
+    def stop(self, name):
+        self.durations.setdefault(name, []).append(time.time() - self.start_time)
+
+    def get_summary(self):
+        return dict((name, {'count': len(durations),
+                            'p50': get_percentile(durations, 50),
+                            'p95': get_percentile(durations, 95)})
+                    for (name, durations) in self.durations.items())
+
+
+def read_first_frame(url_or_path):
+    if url_or_path.startswith('http://'):
+        response = urllib2.urlopen(url_or_path)
+        try:
+            return len(response.read(FIRST_FRAME_SIZE))
+        finally:
+            response.close()
+
+    with open(url_or_path, 'rb') as media_file:
+        return len(media_file.read(FIRST_FRAME_SIZE))
+
+
+# ---- Players --------------------------------------------------------------------------------
+
+def play_video(player, index):
+    # Like PlayerManager.start_download
+    requested_at = time.time()
+    player.download_video_with_index(index)
+    get_tracer().mark(player.current_video.video_id, 'play_requested', timestamp=requested_at)
+    wait_until_current_video_is_playable(player)
+
+
+def wait_until_current_video_is_playable(player):
+    is_playable = threading.Event()
+    player.call_when_current_video_is_playable(is_playable.set)
+    if not is_playable.wait(PLAYABLE_TIMEOUT):
+        raise RuntimeError("The video never became playable")
+    read_first_frame(player.get_current_video_stream_url())
+
+
+def benchmark_downloader(options, directory, search_terms, timings):
+    """
+    Downloader and Video, as used by PlayerManager. Playing is reading the first frame
+    from the stream server, like the player does.
+    """
+    timings.start()
+    player = Downloader(search_terms, directory)
+    play_video(player, 0)
+    timings.stop('search_to_play')
+
+    try:
+        for index in range(1, options.skips + 1):
+            timings.start()
+            play_video(player, index)
+            timings.stop('next_to_play')
+
+        for index in reversed(range(options.skips)):
+            timings.start()
+            play_video(player, index)
+            timings.stop('previous_to_play')
+    finally:
+        player.destroy()
+
+
+def play_legacy_song(player, index):
+    player.download_song(index)
+    path = player.get_downloading_video_path()
+    player.wait_until_song_is_playable(path, LEGACY_FALLBACK_SIZE)
+    read_first_frame(path)
+
+
+def benchmark_legacy_downloader(options, directory, search_terms, timings):
+    """
+    downloader.Downloader, as used by window.py. Playing is reading the first frame of the file.
+    """
+    timings.start()
+    player = legacy_downloader.Downloader(search_terms, directory)
+    play_legacy_song(player, 0)
+    timings.stop('search_to_play')
+
+    indices = range(1, options.skips + 1) + list(reversed(range(options.skips)))
+    names = ['next_to_play'] * options.skips + ['previous_to_play'] * options.skips
+    try:
+        for (index, name) in zip(indices, names):
+            timings.start()
+            if player.is_downloading():
+                player.skip_download_of_song()
+            play_legacy_song(player, index)
+            timings.stop(name)
+    finally:
+        if player.is_downloading():
+            player.skip_download_of_song()
+
+
+def benchmark_ystream2(options, directory, search_terms, timings, feed_server):
+    """
+    ystream2.Player. Its videos are downloaded by pytube, which can't be pointed at a fake
+    server: only the search (until the urls of the videos are known) is measured.
+    """
+    import ystream2
+
+    feed_url = 'http://127.0.0.1:%d' % feed_server.server_address[1]
+    get_content = ystream2.get_content
+    ystream2.get_content = lambda url: get_content(url.replace('https://gdata.youtube.com', feed_url))
+    try:
+        timings.start()
+        ystream2.Player(search_terms, directory, max_length=60)
+        timings.stop('search_to_results')
+    finally:
+        ystream2.get_content = get_content
+
+
+def get_benchmarks():
+    sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIRECTORY), 'other'))
+    benchmarks = [('Downloader', benchmark_downloader),
+                  ('downloader (legacy)', benchmark_legacy_downloader)]
+
+    try:
+        import ystream2
+        benchmarks.append(('ystream2', benchmark_ystream2))
+    except ImportError as e:
+        print("Skipping ystream2: %s" % e)
+
+    return benchmarks
+
+
+# ---- Setup and report ----------------------------------------------------------------------
+
+def install_fake_youtube_dl(work_directory, options):
+    """
+    Puts a 'youtube-dl' running fake_youtube_dl.py first in the PATH of the download processes.
+    """
+    bin_directory = os.path.join(work_directory, 'bin')
+    os.mkdir(bin_directory)
+
+    launcher_path = os.path.join(bin_directory, 'youtube-dl')
+    with open(launcher_path, 'w') as launcher:
+        launcher.write('#!/bin/sh\nexec "%s" "%s" "$@"\n'
+                       % (sys.executable, os.path.join(BENCHMARKS_DIRECTORY, 'fake_youtube_dl.py')))
+    os.chmod(launcher_path, os.stat(launcher_path).st_mode | stat.S_IEXEC)
+
+    os.environ['PATH'] = bin_directory + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_YOUTUBE_DL_BANDWIDTH'] = str(options.bandwidth)
+    os.environ['FAKE_YOUTUBE_DL_LATENCY'] = str(options.download_latency)
+    os.environ['FAKE_YOUTUBE_DL_SIZE'] = str(options.video_size)
+
+
+def set_up(work_directory, options):
+    feed_server = FakeFeedServer(latency=options.feed_latency)
+    utils.YOUTUBE_URL = feed_server.get_feed_url_template()
+    utils.response_cache = ResponseCache(os.path.join(work_directory, 'feed_cache/'))
+
+    install_fake_youtube_dl(work_directory, options)
+    # The fake youtube-dl only works as a process
+    DownloadBackend.default_backend = DownloadBackend.SubprocessBackend()
+    get_shared_bandwidth_manager().set_total_rate(options.total_rate)
+    return feed_server
+
+
+def get_waste(events):
+    # What the downloads cancelled by a 'next' or 'previous' downloaded for nothing
+    cancellations = [details for (trace_id, stage, timestamp, duration, thread_name, details) in events
+                     if stage == 'download_cancelled']
+    return {'cancelled_downloads': len(cancellations),
+            'wasted_bytes': sum(details['wasted_bytes'] for details in cancellations),
+            'wasted_seconds': sum(details['wasted_seconds'] for details in cancellations)}
+
+
+def run_benchmark(name, benchmark, options, work_directory, feed_server):
+    timings = Timings()
+    monitor = ResourceMonitor()
+    first_event = len(get_tracer().get_events())
+    monitor.start()
+
+    try:
+        for run in range(options.runs):
+            # A new search and directory for each run: nothing is cached from the previous one
+            search_terms = ['%s%d' % (re.sub(r'\W', '', name).lower(), run)]
+            directory = os.path.join(work_directory, search_terms[0]) + '/'
+            os.mkdir(directory)
+
+            args = (options, directory, search_terms, timings)
+            if benchmark is benchmark_ystream2:
+                args += (feed_server,)
+            benchmark(*args)
+    finally:
+        result = monitor.stop()
+    result['timings'] = timings.get_summary()
+    result.update(get_waste(get_tracer().get_events()[first_event:]))
+    return result
+
+
+def print_report(results):
+    print("")
+    print("%-22s %-18s %5s %9s %9s" % ('player', 'action', 'n', 'p50 (s)', 'p95 (s)'))
+    for (name, result) in sorted(results.items()):
+        for (action, summary) in sorted(result['timings'].items()):
+            print("%-22s %-18s %5d %9.3f %9.3f" % (name, action, summary['count'], summary['p50'], summary['p95']))
+        print("%-22s cpu: %.2fs (youtube-dl: %.2fs), max threads: %d"
+              % ('', result['cpu_seconds'], result['children_cpu_seconds'], result['max_threads']))
+        print("%-22s cancelled downloads: %d, wasted: %.2f MiB and %.2fs"
+              % ('', result['cancelled_downloads'], result['wasted_bytes'] / 1024.0 ** 2, result['wasted_seconds']))
+
+
+def get_slow_actions(results, max_p95):
+    return ['%s %s' % (name, action)
+            for (name, result) in results.items()
+            for (action, summary) in result['timings'].items()
+            if summary['p95'] > max_p95]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help="number of searches per player")
+    parser.add_argument('--skips', type=int, default=3, help="number of 'next' (and 'previous') per search")
+    parser.add_argument('--video-size', type=int, default=4 * 1024 ** 2, help="size of every video, in bytes")
+    parser.add_argument('--bandwidth', type=float, default=4000, help="bandwidth of the fake youtube-dl, in KiB/s")
+    parser.add_argument('--download-latency', type=float, default=0.2,
+                        help="seconds before the fake youtube-dl starts downloading")
+    parser.add_argument('--feed-latency', type=float, default=0.05, help="seconds before each feed response")
+    parser.add_argument('--total-rate', type=int, default=get_shared_bandwidth_manager().get_total_rate(),
+                        help="bandwidth shared by the downloads, in KiB/s")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--trace', help="write the trace of the stages of every video to this file")
+    parser.add_argument('--max-p95', type=float, help="fail if an action's p95 is above this many seconds")
+    parser.add_argument('--keep', action='store_true', help="keep the downloaded files")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_arguments()
+    work_directory = tempfile.mkdtemp(prefix='youstream-benchmarks-')
+
+    try:
+        feed_server = set_up(work_directory, options)
+        results = {}
+        for (name, benchmark) in get_benchmarks():
+            print("Running %s" % name)
+            results[name] = run_benchmark(name, benchmark, options, work_directory, feed_server)
+    finally:
+        if not options.keep:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    print_report(results)
+    if options.trace:
+        print("")
+        get_tracer().print_summary()
+        get_tracer().export(options.trace)
+
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+
+    if options.max_p95 is not None:
+        slow_actions = get_slow_actions(results, options.max_p95)
+        if slow_actions:
+            print("Slower than %.2fs (p95): %s" % (options.max_p95, ', '.join(slow_actions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
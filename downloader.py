@@ -1,11 +1,23 @@
 # coding=utf-8
 import os
-import string
-import subprocess
-import time
-from multiprocessing.pool import ThreadPool
 
 import utils
+from BandwidthManager import get_shared_bandwidth_manager
+from DownloadBackend import DownloadRequest, get_download_backend
+from DownloadProgress import DownloadProgress
+from DownloadScheduler import get_current_job, get_shared_scheduler, PRIORITY_CURRENT, PRIORITY_PREFETCH
+from FormatSelector import get_format, get_format_selector, ANY_CONTAINER_LADDER
+from MediaCache import get_media_cache
+from StartThreshold import StartThreshold
+from Tracer import get_tracer
+
+
+# How long youtube-dl may take to announce the file it writes
+PATH_TIMEOUT = 30
+PAGE_SIZE = 10
+# What is known of the songs further than this from the current one is forgotten: the feed
+# cache and the media cache give it back if the user returns to them
+RETAINED_SONGS = 20
 
 
 class Downloader(object):
@@ -19,8 +31,10 @@ class Downloader(object):
 
     def __init__(self, search_terms, directory):
         self.search_terms = search_terms
-        self.songs_metadata = utils.get_songs_metadata(search_terms)
+        # By index: only the songs close to the current one are kept
+        self.songs_metadata = dict(enumerate(utils.get_songs_metadata(search_terms)))
         self.directory = directory
+        self.media_cache = get_media_cache(directory)
 
         self.current_song_index = 0
         self.is_downloading_now = False
@@ -31,30 +45,58 @@ class Downloader(object):
         self.downloaded_songs_indices = set()
         self.downloaded_songs_paths = {}
 
-        self.pool = None
-        self.download_subprocess = None
+        self.scheduler = get_shared_scheduler()
+        self.download_job = None
+        self.download_backend = get_download_backend()
+        self.download_request = None
+        self.progress = DownloadProgress()
+        self.bandwidth_manager = get_shared_bandwidth_manager()
+        self.rate_limiter = None
+        self.format_selector = get_format_selector()
+        self.quality = None
+
+    def add_songs_metadata_of_page(self, index):
+        """
+        Fetches the metadata of the page of songs that contains the given index.
+        @param index: the index of the song
+        @return: None
+        """
+        first_index = index - index % PAGE_SIZE
+        # Youtube counts the songs from 1
+        metadata = utils.get_songs_metadata(self.search_terms, first_index + 1, PAGE_SIZE)
+        self.songs_metadata.update(enumerate(metadata, first_index))
 
-        # Since we have already the first 10
-        self.index_of_next_songs_to_download = 11
+    def forget_distant_songs(self):
+        """
+        Forgets the metadata and paths of the songs far from the current one, so that the memory
+        doesn't grow with the length of the session.
+        @return: None
+        """
+        def is_distant(index):
+            return abs(index - self.current_song_index) > RETAINED_SONGS
 
-    def get_next_10_songs_metadata(self):
-        metadata = utils.get_songs_metadata(self.search_terms, self.index_of_next_songs_to_download)
-        self.index_of_next_songs_to_download += 10
-        return metadata
+        for index in filter(is_distant, self.songs_metadata.keys()):
+            del self.songs_metadata[index]
+        for index in filter(is_distant, self.downloaded_songs_paths.keys()):
+            del self.downloaded_songs_paths[index]
+        self.downloaded_songs_indices = set(index for index in self.downloaded_songs_indices if not is_distant(index))
 
-    def add_next_10_songs_metadata(self):
-        new_metadata = self.get_next_10_songs_metadata()
-        self.songs_metadata.extend(new_metadata)
+    def get_memory_report(self):
+        """
+        @return: how many songs have their metadata and path in memory
+        """
+        return {'results': len(self.songs_metadata),
+                'downloaded_songs': len(self.downloaded_songs_paths)}
 
     def need_to_get_metadata(self):
-        return len(self.songs_metadata) > self.current_song_index and \
-            'url' in self.songs_metadata[self.current_song_index]
+        return self.current_song_index not in self.songs_metadata
 
     def is_next_song_to_download(self):
-        return not self.need_to_get_metadata()
+        return not self.need_to_get_metadata() and \
+            self.songs_metadata[self.current_song_index].url is not None
 
     def get_current_song_url(self):
-        return self.songs_metadata[self.current_song_index]['url']
+        return self.songs_metadata[self.current_song_index].url
 
     def get_song_url(self):
         if self.is_next_song_to_download():
@@ -67,7 +109,7 @@ class Downloader(object):
         @return: The url of the next song. (None if none can be found)
         """
         if self.need_to_get_metadata():
-            self.add_next_10_songs_metadata()
+            self.add_songs_metadata_of_page(self.current_song_index)
 
         return self.get_song_url()
 
@@ -81,6 +123,7 @@ class Downloader(object):
         @return: None
         """
         self.current_song_index = index
+        self.forget_distant_songs()
         url = self.get_next_song_url()
         print("Got url:", url)
 
@@ -88,17 +131,41 @@ class Downloader(object):
             print("No more songs")
             return
 
-        title = self.get_title(url)
+        if not is_prefetching:
+            get_tracer().mark(utils.get_video_id(url), 'play_requested')
+
+        if self.use_cached_song(url, index):
+            return
 
         try:
-            print("Title:", title)
+            print("Title:", self.songs_metadata[index].title)
             self.start_downloading(url, index, is_prefetching)
             print("Getting path")
-            self.path_of_video_being_downloaded = self.get_song_path_from_title(title)
+            self.path_of_video_being_downloaded = self.get_song_path()
+            get_tracer().mark(utils.get_video_id(url), 'path_resolved')
             print("Got path:", self.path_of_video_being_downloaded)
         except (OSError, IOError):
             self.skip_download_of_song()
 
+    def use_cached_song(self, url, index):
+        """
+        If the song was already downloaded (in this session or a previous one), marks it as
+        downloaded without using the network.
+        @param url: the url of the song.
+        @param index: the index of the song.
+        @return: true if the song was found in the cache
+        """
+        cached_path = self.media_cache.get_path(utils.get_video_id(url))
+        if cached_path is None:
+            return False
+
+        print("Found in cache:", cached_path)
+        self.media_cache.mark_as_played(utils.get_video_id(url))
+        self.downloaded_songs_indices.add(index)
+        self.downloaded_songs_paths[index] = cached_path
+        self.last_video_finished_filepath = cached_path
+        return True
+
     def start_downloading(self, url, index, is_prefetching=False):
         """
         Start a asynchronous thread to download the next song and set the appropriate flags.
@@ -108,9 +175,31 @@ class Downloader(object):
         @return: None
         """
         self.is_downloading_now = True
-        self.pool = ThreadPool(processes=1)
-        self.pool.apply_async(self.download_wait_until_end_and_quit, args=(url, index, is_prefetching))
-        self.pool.close()
+        self.progress = DownloadProgress()
+        self.download_request = self.create_download_request(url, index, is_prefetching)
+        priority = PRIORITY_PREFETCH if is_prefetching else PRIORITY_CURRENT
+        self.download_job = self.scheduler.submit(self.download_wait_until_end_and_quit,
+                                                  args=(url, index, is_prefetching),
+                                                  priority=priority,
+                                                  on_cancel=self.download_request.cancel)
+
+    def create_download_request(self, url, index, is_prefetching=False):
+        """
+        Describes the download of the song for the download backend. The quality is picked by the
+        format selector, from the download rate of the previous songs and the length of this one.
+        The file is named after the id of the video and its format, so that it always has the same
+        name, whatever the title, and a download is only resumed in the same format.
+        @param url: the url of the song.
+        @param index: the index of the song.
+        @param is_prefetching: the prefetching flag: a prefetched song doesn't step the quality up
+        @return: the DownloadRequest
+        """
+        self.quality = self.format_selector.select(self.get_length(index), ANY_CONTAINER_LADDER, is_prefetching)
+        video_format = get_format(self.quality, ANY_CONTAINER_LADDER)
+        # Only a ceiling: the actual rate is set by the bandwidth manager while downloading
+        download_rate = min(self.max_download_rate, self.bandwidth_manager.get_total_rate())
+        return DownloadRequest(url, self.directory + '%(id)s-%(format_id)s.%(ext)s', video_format,
+                               self.progress, download_rate, trace_id=utils.get_video_id(url))
 
     def wait_while_file_is_small(self, path, size):
         """
@@ -121,125 +210,139 @@ class Downloader(object):
         @param size: the minimum size
         @return: None
         """
-        # todo: if file is smaller that minimum size, must also return when it ended
-        while self.is_downloading_now and (not os.path.exists(path) or os.path.getsize(path) < size):
-            time.sleep(0.3)
-            print("Too small")
+        if self.is_downloading_now:
+            if not self.progress.get_file_path():
+                self.progress.set_file_path(path)
+            self.progress.wait_until_size(size)
+            get_tracer().mark(utils.get_video_id(self.get_current_song_url()), 'threshold_reached', size=size)
 
-    def get_title(self, url):
+    def wait_until_song_is_playable(self, path, fallback_size):
         """
-        Return the title of the song at the provided url.
-        @param url: the url of the song.
-        @return: the title of the song.
+        Waits until the song can play to its end without catching up with the download, or
+        the download ended. How much is needed depends on the bitrate of the song and on how
+        fast it downloads. While that is not known, waits for fallback_size bytes.
+        @param path: the path of the file
+        @param fallback_size: the minimum size, when the bitrate or download rate is unknown
+        @return: None
         """
-        # todo: there is discrepancy between title returned by this process
-        # todo: and the title written on disk. Must find out why
-        title = subprocess.check_output(['youtube-dl', '-e', url])
-        return title.strip()
+        if self.is_downloading_now:
+            if not self.progress.get_file_path():
+                self.progress.set_file_path(path)
+            threshold = StartThreshold(self.get_length(self.current_song_index), fallback_size)
+            self.progress.wait_until(threshold.is_reached)
+            get_tracer().mark(utils.get_video_id(self.get_current_song_url()), 'threshold_reached',
+                              size=self.progress.get_downloaded_bytes())
 
     def skip_download_of_song(self):
         """
-        Skips the download of the current song. First, tries to terminate the subprocess.
-        Then terminates the thread pool and sets the appropriate flag.
-        Sleeps for 1 second. Why ????  I don't know
+        Skips the download of the current song. First, cancels the download and the download job,
+        then sets the appropriate flag. The incomplete file is kept, so that downloading the song
+        again resumes where it stopped. The process of the download is torn down in the background.
         @return: None
         """
-        if self.download_subprocess and self.download_subprocess.poll() is None:
-            self.download_subprocess.terminate()
+        if self.download_request:
+            self.download_request.cancel()
+        self.close_rate_limiter()
 
-        if self.pool:
-            self.pool.terminate()
+        if self.download_job:
+            self.download_job.cancel()
 
         self.is_downloading_now = False
-        self.download_subprocess = None
-        self.pool = None
+        self.download_request = None
+        self.download_job = None
         self.path_of_video_being_downloaded = None
-        time.sleep(1)
+        self.progress.finish()
 
     def download_wait_until_end_and_quit(self, url, index, is_prefetching=False):
         """
-        Starts the download subprocess and waits until it finishes. Then it add it to the
-        downloaded songs set and sets the appropriate flags.
+        Downloads the song with the download backend and waits until it finishes. Then it add it
+        to the downloaded songs set and sets the appropriate flags.
         @param url:
         @param index:
         @param is_prefetching:
         @return:
         """
         print("Download started")
-        self.start_download_subprocess(url, is_prefetching)
+        progress = self.progress
+        request = self.download_request
+        quality = self.quality
+        # The download rate is shared with the other downloads by the bandwidth manager,
+        # which gives less of it to prefetches
+        self.rate_limiter = self.bandwidth_manager.open_stream(is_foreground=not is_prefetching)
+        request.rate_limiter = self.rate_limiter
+        if get_current_job().was_cancelled():
+            request.cancel()
+
         print("Waiting")
-        self.download_subprocess.wait()
+        try:
+            is_complete = self.download_backend.download(request)
+        finally:
+            self.close_rate_limiter()
+            # Prefetches only get a share of the bandwidth: they say little about the link
+            if not is_prefetching:
+                self.format_selector.report(quality, progress.get_download_rate())
         print("Download ended")
 
+        if get_current_job().was_cancelled():
+            return
+
+        if not is_complete:
+            print("Download failed")
+            self.is_downloading_now = False
+            self.download_request = None
+            self.download_job = None
+            progress.finish()
+            return
+
+        self.path_of_video_being_downloaded = progress.get_file_path()
+
         # If song was not already downloaded
         if self.path_of_video_being_downloaded[-5:] == '.part':
             self.last_video_finished_filepath = self.path_of_video_being_downloaded[:-5]
         else:
             self.last_video_finished_filepath = self.path_of_video_being_downloaded
 
+        self.media_cache.add(utils.get_video_id(url), self.last_video_finished_filepath)
         self.downloaded_songs_indices.add(index)
-        self.downloaded_songs_paths[index] = self.path_of_video_being_downloaded
+        self.downloaded_songs_paths[index] = self.last_video_finished_filepath
         self.is_downloading_now = False
         self.path_of_video_being_downloaded = None
-        self.pool = None
+        self.download_request = None
+        self.download_job = None
+        progress.finish()
         print("Quit function: download")
 
-    def start_download_subprocess(self, url, is_prefetching=False):
+    def close_rate_limiter(self):
         """
-        Starts the download subprocess. Specifies a special file name format and a preference in
-        the quality of the videos. If the prefetching flag is set, then the download rate will be
-        2 x slower.
-        @param url: the url of the song .
-        @param is_prefetching: the prefetching flag.
+        Gives the bandwidth of the current download back to the other downloads.
         @return: None
         """
-        preferred_formats = ['18', '34', '43', '5', '44', '35', '17', '45', '22', '46', '37']
-        preferred_formats = '/'.join(preferred_formats)
-
-        args = ["youtube-dl"]
-        args.extend(['-o', self.directory + '%(title)s.%(ext)s'])
-        args.extend(['-f', preferred_formats])
-        #args.append('-q')
-        if is_prefetching:
-            download_rate = self.max_download_rate // 2
-        else:
-            download_rate = self.max_download_rate
+        rate_limiter, self.rate_limiter = self.rate_limiter, None
+        if rate_limiter:
+            rate_limiter.close()
 
-        args.extend(['-r', "%dk" % download_rate])
-        args.append(url)
-
-        self.download_subprocess = subprocess.Popen(args)
-
-    def get_song_path_from_title(self, title):
+    def get_song_path(self):
         """
-        Searches the song directory for the complete file path. Tries to find it via
-        the name of the song and knowledge about the common file extensions.
-        @param title: the title of the song
+        Returns the path of the file being downloaded, as announced by the download backend. The
+        file is named after the id of the video, so only its extension depends on the chosen format.
+        Until the download completes, this is the '.part' file: the complete one doesn't exist yet.
         @return: the full filepath of the song
+        @raise IOError: if the download ended or didn't announce the file in time
         """
-        # '.part' for when videos are still being downloaded
-        extensions = ['.mp4', '.flv', '.webm',
-                      '.mp4.part', '.flv.part', '.webm.part']
-        # youtube-dl adds .part when file is still downloading
-
-        # Fixes bug where ' would be used by youtube-dl and " by OS
-        title_escaped = string.replace(title, '"', "'")
+        path = self.progress.wait_for_file_path(PATH_TIMEOUT)
+        if path is None:
+            raise IOError("The download did not start")
+        return path
 
-        #for extension in extensions:
-        #    print("Possible extension: ", self.directory + title + extension)
-
-        while True:
-            for extension in extensions:
-                path = unicode(self.directory + title + extension)
-                if os.path.exists(path):
-                    return path
-
-                path = unicode(self.directory + title_escaped + extension)
-                if os.path.exists(path):
-                    return path
-
-            time.sleep(0.2)
-            print("No path: ", self.directory + title)
+    def get_playable_path(self, path):
+        """
+        Returns the path the song can be read from: the '.part' file is renamed when its download completes.
+        @param path: the path of the song, as returned while it was downloaded
+        @return: the path of the file on disk
+        """
+        if path.endswith('.part') and not os.path.exists(path):
+            return path[:-len('.part')]
+        return path
 
     def get_downloading_video_path(self):
         """
@@ -277,7 +380,7 @@ class Downloader(object):
 
         try:
             return self.downloaded_songs_paths[index]
-        except IndexError:
+        except KeyError:
             return ""
 
     def get_length(self, index):
@@ -286,4 +389,4 @@ class Downloader(object):
         @param index: the index of the song
         @return: the length of the file.
         """
-        return self.songs_metadata[index]['length']
+        return self.songs_metadata[index].length
@@ -0,0 +1,74 @@
+# coding=utf-8
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from run_benchmarks import install_fake_youtube_dl
+from DownloadBackend import DownloadRequest, SubprocessBackend
+from DownloadProgress import DownloadProgress
+from PartialDownload import PartialDownload, SIDECAR_SUFFIX
+
+
+VIDEO_SIZE = 1024 ** 2
+URL = 'https://www.youtube.com/watch?v=abc'
+
+
+class SubprocessBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environment = dict(os.environ)
+        install_fake_youtube_dl(self.directory, argparse.Namespace(bandwidth=2000, download_latency=0,
+                                                                   video_size=VIDEO_SIZE))
+        self.path = os.path.join(self.directory, 'abc.medium.mp4')
+        self.part_path = self.path + '.part'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.directory)
+
+    def create_request(self, partial_download=None, max_bytes=None):
+        return DownloadRequest(URL, self.path, 'mp4', DownloadProgress(), 10000, partial_download,
+                               max_bytes=max_bytes)
+
+    def test_skipped_download_is_resumed(self):
+        request = self.create_request()
+        request.progress.call_when_size_reached(VIDEO_SIZE / 4, request.cancel)
+        self.assertFalse(SubprocessBackend().download(request))
+
+        # The bytes on disk are recorded next to the '.part' file, named after the complete one
+        self.assertTrue(os.path.exists(self.part_path + SIDECAR_SUFFIX))
+        partial_download = PartialDownload(self.part_path)
+        kept_bytes = partial_download.get_contiguous_bytes()
+        self.assertTrue(0 < kept_bytes < VIDEO_SIZE)
+        self.assertEqual(partial_download.total_bytes, VIDEO_SIZE)
+
+        request = self.create_request(partial_download)
+        request.progress.update(kept_bytes)
+        self.assertTrue(SubprocessBackend().download(request))
+        self.assertEqual(os.path.getsize(self.path), VIDEO_SIZE)
+        self.assertFalse(os.path.exists(self.part_path + SIDECAR_SUFFIX))
+
+    def test_head_download_stops_at_max_bytes(self):
+        # The next request of youtube-dl would come after this latency
+        os.environ['FAKE_YOUTUBE_DL_LATENCY'] = '0.3'
+        request = self.create_request(max_bytes=VIDEO_SIZE / 4)
+        self.assertFalse(SubprocessBackend().download(request))
+        self.assertTrue(request.has_reached_max_bytes)
+        # Stopped at the first bytes of the next request
+        self.assertTrue(VIDEO_SIZE / 4 < os.path.getsize(self.part_path) < VIDEO_SIZE / 2)
+
+    def test_head_download_of_a_short_video_is_complete(self):
+        request = self.create_request(max_bytes=VIDEO_SIZE)
+        self.assertTrue(SubprocessBackend().download(request))
+        self.assertEqual(os.path.getsize(self.path), VIDEO_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from DownloadProgress import DownloadProgress
+
+
+class DownloadProgressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'abc.medium.mp4')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_destination_is_the_part_file_while_downloading(self):
+        # youtube-dl names the complete file, while it writes the '.part' one
+        progress = DownloadProgress()
+        progress.parse_output_line("[download] Destination: %s\n" % self.path)
+        self.assertEqual(progress.get_file_path(), self.path + '.part')
+
+    def test_destination_is_the_complete_file_once_finished(self):
+        progress = DownloadProgress()
+        progress.parse_output_line("[download] Destination: %s\n" % self.path)
+        open(self.path, 'wb').close()
+        progress.finish()
+        self.assertEqual(progress.get_file_path(), self.path)
+
+    def test_destination_stays_the_part_file_of_an_unfinished_download(self):
+        progress = DownloadProgress()
+        progress.parse_output_line("[download] Destination: %s\n" % self.path)
+        open(self.path + '.part', 'wb').close()
+        progress.finish()
+        self.assertEqual(progress.get_file_path(), self.path + '.part')
+
+    def test_already_downloaded_file_is_the_complete_file(self):
+        progress = DownloadProgress()
+        progress.parse_output_line("[download] %s has already been downloaded\n" % self.path)
+        self.assertEqual(progress.get_file_path(), self.path)
+
+    def test_progress_line(self):
+        progress = DownloadProgress()
+        progress.parse_output_line("[download]  25.0% of 4.00MiB at 512.00KiB/s ETA 00:06\n")
+        self.assertEqual(progress.get_total_bytes(), 4 * 1024 ** 2)
+        self.assertEqual(progress.get_downloaded_bytes(), 1024 ** 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# coding=utf-8
+import unittest
+
+from PlaybackState import PlaybackState
+
+
+class PlaybackStateTest(unittest.TestCase):
+
+    def test_length_from_identify(self):
+        playback_state = PlaybackState()
+        for line in ["ID_VIDEO_ID=0", "ID_LENGTH=213.00", "ID_SEEKABLE=1"]:
+            playback_state.on_output(line)
+        self.assertEqual(playback_state.get_length(), 213)
+
+    def test_position_from_status_line(self):
+        playback_state = PlaybackState()
+        playback_state.on_output("ID_LENGTH=213.00")
+        playback_state.on_output("A:  12.3 V:  12.3 A-V:  0.000 ct:  0.004 309/309  2%  0%  0.4% 0 0")
+        self.assertAlmostEqual(playback_state.get_position(), 12.3)
+
+    def test_position_from_video_only_status_line(self):
+        playback_state = PlaybackState()
+        playback_state.on_output("V:  41.5   996/996  3%  1%  0.0% 0 0")
+        self.assertAlmostEqual(playback_state.get_position(), 41.5)
+
+    def test_position_from_answer(self):
+        playback_state = PlaybackState()
+        playback_state.on_output("ANS_TIME_POSITION=12.3")
+        self.assertAlmostEqual(playback_state.get_position(), 12.3)
+
+    def test_position_moves_on_while_playing(self):
+        playback_state = PlaybackState()
+        playback_state.on_output("ID_LENGTH=213.00")
+        playback_state.on_started()
+        playback_state.set_position(212.9)
+        playback_state.updated_at -= 10
+        self.assertEqual(playback_state.get_position(), 213)
+
+    def test_other_lines_are_ignored(self):
+        playback_state = PlaybackState()
+        for line in ["Starting playback...", "AO: [pulse] 44100Hz 2ch s16le (2 bytes per sample)",
+                     "VIDEO:  [H264]  640x360  24bpp  29.970 fps  500.0 kbps (61.0 kbyte/s)"]:
+            playback_state.on_output(line)
+        self.assertEqual(playback_state.get_position(), 0)
+        self.assertIsNone(playback_state.get_length())
+
+
+if __name__ == '__main__':
+    unittest.main()
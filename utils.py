@@ -1,11 +1,23 @@
 # coding=utf-8
+import hashlib
 import json
 import os
 import urllib2
+import urlparse
+
+from ResponseCache import ResponseCache
+from Tracer import get_tracer
+from VideoMetadata import VideoMetadata
 
 DEFAULT_DIRECTORY = os.path.dirname(os.path.realpath(__file__)) + '/songs/'
 YOUTUBE_URL = 'https://gdata.youtube.com/feeds/api/videos?q=%s&alt=json&start_index=%d&max-results=%d'
 
+# The only keys of the feed the application reads. Everything else is dropped while parsing.
+FEED_KEYS = frozenset(['feed', 'entry', 'author', 'name', '$t', 'media$group', 'media$title',
+                       'yt$duration', 'seconds', 'media$content', 'duration', 'link', 'href', 'updated'])
+
+response_cache = ResponseCache(DEFAULT_DIRECTORY + 'feed_cache/')
+
 
 def download_json(search_terms_list, start_index, max_results=10):
     """
@@ -18,8 +30,64 @@ def download_json(search_terms_list, start_index, max_results=10):
     @return: the Json downloaded from Youtube
     """
     url = YOUTUBE_URL % ('+'.join(search_terms_list), start_index, max_results)
-    response = urllib2.urlopen(url).read()
-    return json.loads(response)
+    key = (tuple(search_terms_list), start_index, max_results)
+    trace_id = 'feed:%s:%d' % ('+'.join(search_terms_list), start_index)
+
+    with get_tracer().measure(trace_id, 'feed_fetch'):
+        response = download_with_cache(url, key)
+    with get_tracer().measure(trace_id, 'metadata_parse'):
+        return parse_feed(response)
+
+
+def parse_feed(response):
+    """
+    Parses the Json feed, keeping only the keys the application uses. Each object is pruned
+    as soon as it is decoded, so the unused parts of the feed never accumulate in memory.
+    @param response: the body of the feed
+    @return: the pruned Json
+    """
+    return json.loads(response, object_pairs_hook=keep_feed_keys)
+
+
+def keep_feed_keys(pairs):
+    return dict((key, value) for (key, value) in pairs if key in FEED_KEYS)
+
+
+def download_with_cache(url, key):
+    """
+    Returns the body of the response at the url, using the response cache. A fresh cached
+    response is returned without using the network. A stale one is revalidated with a
+    conditional request (If-None-Match / If-Modified-Since), and reused if the server
+    answers that it has not changed. If the network fails, a stale response is better than none.
+    @param url: the url to download
+    @param key: the key of the response in the cache
+    @return: the body of the response
+    """
+    entry = response_cache.get(key)
+    if entry is not None and response_cache.is_fresh(entry):
+        return entry['body']
+
+    request = urllib2.Request(url)
+    if entry is not None:
+        if entry['etag']:
+            request.add_header('If-None-Match', entry['etag'])
+        if entry['last_modified']:
+            request.add_header('If-Modified-Since', entry['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code == 304 and entry is not None:
+            return response_cache.refresh(key, entry)['body']
+        raise
+    except urllib2.URLError:
+        if entry is not None:
+            return entry['body']
+        raise
+
+    body = response.read()
+    response_cache.put(key, body, response.info().getheader('ETag'), response.info().getheader('Last-Modified'))
+    return body
 
 
 def get_length_from_metadata_entry(entry):
@@ -32,13 +100,13 @@ def get_length_from_metadata_entry(entry):
     try:
         length = entry['media$group']['yt$duration']['seconds']
         return int(length)
-    except KeyError:
+    except (KeyError, IndexError, ValueError):
         pass
 
     try:
         length = entry['media$group']['media$content'][0]['duration']
         return int(length)
-    except KeyError:
+    except (KeyError, IndexError, ValueError):
         pass
 
     return None
@@ -52,7 +120,8 @@ def get_entries(json_file):
     """
     try:
         return json_file['feed']['entry']
-    except AttributeError:
+    except (KeyError, AttributeError):
+        # The last page of results has no entries
         return []
 
 
@@ -71,23 +140,25 @@ def try_to_get_attribute(entry, *args):
         for arg in args:
             result = result[arg]
         return result
-    except AttributeError:
+    except (KeyError, IndexError, TypeError, AttributeError):
         return None
 
 
 def get_metadata_from_entry(entry):
     # todo: (image? one day maybe)
     """
-    Returns all the metadata found in the entry as a dictionary. It searches for name, length,
-    url, author/poster, date posted and number of views.
-    @param entry:
-    @return:
+    Returns the metadata found in the entry as a VideoMetadata. It searches for title, length,
+    url, author/poster and date posted.
+    @param entry: the entry of the feed
+    @return: the VideoMetadata of the video
     """
-    return { 'author': try_to_get_attribute(entry, 'author', 0, 'name', '$t'),
-             'name': try_to_get_attribute(entry, 'media$group', 'media$title', '$t'),
-             'url': try_to_get_attribute(entry, 'link', 0, 'href'),
-             'date': try_to_get_attribute(entry, 'updated', '$t'),
-             'length': get_length_from_metadata_entry(entry) }
+    url = try_to_get_attribute(entry, 'link', 0, 'href')
+    return VideoMetadata(video_id=get_video_id(url),
+                         author=try_to_get_attribute(entry, 'author', 0, 'name', '$t'),
+                         title=try_to_get_attribute(entry, 'media$group', 'media$title', '$t'),
+                         url=url,
+                         date=try_to_get_attribute(entry, 'updated', '$t'),
+                         length=get_length_from_metadata_entry(entry))
 
 
 def get_metadata(json_file):
@@ -114,6 +185,24 @@ def get_songs_metadata(search_terms, start_index=1, max_results=10):
     return get_metadata(json_file)
 
 
+def get_video_id(url):
+    """
+    Returns the Youtube id of the video at the given url (the 'v' parameter of
+    a watch url). If it can't be found, a hash of the url is used as id, so that
+    the id can always be used as a file name.
+    @param url: the url of the video
+    @return: the id of the video
+    """
+    if not url:
+        return None
+
+    query = urlparse.parse_qs(urlparse.urlparse(url).query)
+    try:
+        return query['v'][0]
+    except (KeyError, IndexError):
+        return hashlib.sha1(url).hexdigest()
+
+
 def make_directory(directory):
     if not directory:
         directory = os.getcwd() + '/songs/'
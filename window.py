@@ -1,12 +1,12 @@
 # coding=utf-8
 import os
 import wx
-from multiprocessing.pool import ThreadPool
-import time
 
 import MplayerCtrl as mpc
 
 from downloader import Downloader
+from DownloadScheduler import DownloadScheduler
+from PlaybackState import PlaybackState, MPLAYER_ARGS
 
 
 DEFAULT_WIDTH = 1000
@@ -18,10 +18,10 @@ class MainWindow(wx.Frame):
         super(MainWindow, self).__init__(parent=None, title="YouStream",
                                          size=(DEFAULT_WIDTH, DEFAULT_HEIGHT))
         self.downloader = None
-        self.pool = None
-        self.current_func_pool = None
-        self.is_downloading = False
-        self.file_being_downloaded = None
+        # Runs the actions of the user and the waits before playing, away from the UI thread
+        self.scheduler = DownloadScheduler(max_concurrent_downloads=2)
+        self.play_job = None
+        self.current_func_job = None
         self.index_of_song_being_downloaded = 0
 
         self.is_watching = False
@@ -30,6 +30,8 @@ class MainWindow(wx.Frame):
         self.video_being_played = None
         self.index_of_song_being_watched = 0
         self.length = None
+        # Fed by the output of mplayer, so that the gauge never queries it
+        self.playback_state = PlaybackState()
 
         self.gauge_bar_offset = 0
         self.number_of_songs_predownloaded = 0
@@ -76,12 +78,13 @@ class MainWindow(wx.Frame):
         playerButtonsSizer = self.create_player_button_sizer()
 
         # Add player and events
-        self.mediaPlayer = mpc.MplayerCtrl(self.panel, -1, 'mplayer')
+        self.mediaPlayer = mpc.MplayerCtrl(self.panel, -1, 'mplayer', mplayer_args=MPLAYER_ARGS)
 
         self.panel.Bind(mpc.EVT_MEDIA_STARTED, self.on_media_started)
         self.panel.Bind(mpc.EVT_MEDIA_FINISHED, self.on_media_finished)
         self.panel.Bind(mpc.EVT_PROCESS_STARTED, self.on_process_started)
         self.panel.Bind(mpc.EVT_PROCESS_STOPPED, self.on_process_stopped)
+        self.panel.Bind(mpc.EVT_STDOUT, self.on_player_output)
 
         # Add sizer to outer sizer
         outerBoxSizer.Add(searchInputSizer, 0, wx.ALL | wx.EXPAND, 5)
@@ -100,6 +103,7 @@ class MainWindow(wx.Frame):
         """
         print("media_started")
         self.playing = True
+        self.playback_state.on_started()
         self.gauge_bar_offset = 0
         self.length = self.downloader.get_length(self.index_of_song_being_watched)
         print("Length of file: ", self.length)
@@ -114,6 +118,7 @@ class MainWindow(wx.Frame):
         """
         print("media_finished")
         self.playing = False
+        self.playback_state.on_finished()
         self.length = float('infinity')
 
     def on_process_started(self, evt):
@@ -122,6 +127,9 @@ class MainWindow(wx.Frame):
     def on_process_stopped(self, evt):
         print("process_stopped")
 
+    def on_player_output(self, evt):
+        self.playback_state.on_output(evt.data)
+
     def create_gauge_bar_sizer(self):
         """
         Creates the gauge bar.
@@ -210,20 +218,12 @@ class MainWindow(wx.Frame):
 
     def update_gauge(self):
         """
-        If the player is on and we have the length of the current file, we try to
-        update the gauge bar. If we can't access the position in the file or the
-        length of the video, we default to 0.
+        If the player is on and we have the length of the current file, we update the
+        gauge bar with the position reported by the player (without querying it).
         @return: None
         """
         if self.playing and self.length:
-            try:
-                self.gauge_bar_offset = self.mediaPlayer.time_pos
-            except AttributeError:
-                # Hack when media player doesnt work (ALWAYS !!!!!) The value is 0.1s because that is the timer offset
-                self.gauge_bar_offset += 0.1
-
-        if type(self.gauge_bar_offset) != int and type(self.gauge_bar_offset) != float:
-            self.gauge_bar_offset = 0
+            self.gauge_bar_offset = self.playback_state.get_position()
 
         self.gauge_bar.SetValue(int(self.gauge_bar_offset))
 
@@ -267,10 +267,8 @@ class MainWindow(wx.Frame):
         """
         is_prefetching = (self.number_of_songs_predownloaded != 0)
         self.number_of_songs_predownloaded += 1
-        self.is_downloading = True
         self.index_of_song_being_downloaded = index
         self.downloader.download_song(index, is_prefetching)
-        self.file_being_downloaded = self.downloader.get_downloading_video_path()
 
     # ------------- Watch ----------------------------------------
 
@@ -342,13 +340,14 @@ class MainWindow(wx.Frame):
         path = self.downloader.get_file_path(index)
         self.playing = True
         self.paused = False
-        self.pool = ThreadPool(processes=1)
-        self.pool.apply_async(self.wait_while_small_then_play_song, args=(path, ))
-        self.pool.close()
+        if self.play_job:
+            self.play_job.cancel()
+        self.play_job = self.scheduler.submit(self.wait_while_small_then_play_song, args=(path, ))
 
     def wait_while_small_then_play_song(self, path):
         """
-        Waits while the file size is below 1.5 MB, then loads the file.
+        Waits until the file can be played to its end without catching up with the download
+        (1.5 MB if that can't be computed yet), then loads the file.
         After that sets the gauge bar back to the beginning.
         @param path: the path of the file
         @return: None
@@ -357,7 +356,8 @@ class MainWindow(wx.Frame):
 
         self.number_of_songs_predownloaded -= 1
         if not self.downloader.is_song_already_downloaded(self.index_of_song_being_watched):
-            self.downloader.wait_while_file_is_small(path, MIN_FILE_SIZE)
+            self.downloader.wait_until_song_is_playable(path, MIN_FILE_SIZE)
+            path = self.downloader.get_playable_path(path)
             print("File is big enough to play. Size:", os.path.getsize(path))
         self.load_file(path)
         self.gauge_bar_offset = 0
@@ -379,6 +379,7 @@ class MainWindow(wx.Frame):
                 # self.mediaPlayer.Quit()
                 self.mediaPlayer.Start()
             self.mediaPlayer.Loadfile(path)
+            self.playback_state.on_file_loaded()
             if loop:
                 self.mediaPlayer.Loop(0)
 
@@ -431,7 +432,6 @@ class MainWindow(wx.Frame):
             self.playing = False
             self.video_being_played = None
             self.number_of_songs_predownloaded = 0
-            self.is_downloading = False
             self.length = None
             print("Stopping current download.")
         print("Starting next download.")
@@ -440,7 +440,6 @@ class MainWindow(wx.Frame):
         self.download_if_needed_wait_and_watch_video(index=0)
         self.is_watching = True
         print("Started to watch the next song.")
-        time.sleep(2)
 
     def on_search(self, evt):
         # Todo: search if event is press on button or keypress on the return key
@@ -448,7 +447,6 @@ class MainWindow(wx.Frame):
         This is the event handler for the search box. When a request is made,
         if find the search tokens. Then, if the media player is started (not necessarily on play),
         it stops the current media player and sets the appropriate flags.
-        Note: It sleeps for two seconds. Why??? I don't know.
         @param evt: the event
         @return: None
         """
@@ -468,6 +466,7 @@ class MainWindow(wx.Frame):
 
         if self.paused:
             self.mediaPlayer.Pause()  # Strangely, this method toggles the pause attribute (bad name)
+            self.playback_state.unpause()
         self.paused = False
 
     def on_pause(self, evt):
@@ -480,6 +479,7 @@ class MainWindow(wx.Frame):
         print("Stop")
         if not self.paused:
             self.mediaPlayer.Pause()
+            self.playback_state.pause()
         self.paused = True
 
     def on_reset(self, evt):
@@ -490,6 +490,7 @@ class MainWindow(wx.Frame):
         @return: None
         """
         self.mediaPlayer.Seek(0, type_=1)
+        self.playback_state.set_position(0)
         self.gauge_bar.SetValue(0)
 
     def on_next(self, evt):
@@ -529,12 +530,12 @@ class MainWindow(wx.Frame):
         # In case this line is triggered before the download started, we check that it is not None
         # This can be the case because the download is asynchronous and takes
         # some time to start
-        self.is_downloading = self.is_watching and self.downloader and self.downloader.is_downloading()
+        is_downloading = self.is_watching and self.downloader and self.downloader.is_downloading()
 
         # If download stopped and we were not playing the video, mark it as ready for later use
         if self.is_watching:
 
-            if self.downloader and not self.is_downloading and self.number_of_songs_predownloaded <= 2:
+            if self.downloader and not is_downloading and self.number_of_songs_predownloaded <= 2:
                 print("Downloading next song")
                 self.fetch_next_song()
 
@@ -570,14 +571,13 @@ class MainWindow(wx.Frame):
 
     def run_function_asychronously(self, function, *args, **kwargs):
         print(args, kwargs)
-        self.try_to_terminate_previous_pool()
-        self.current_func_pool = ThreadPool(processes=1)
-        self.current_func_pool.apply_async(function, args, kwargs)
-
-    def try_to_terminate_previous_pool(self):
-        if self.current_func_pool:
-            self.current_func_pool.terminate()
-        self.current_func_pool = None
+        self.try_to_cancel_previous_function()
+        self.current_func_job = self.scheduler.submit(lambda: function(*args, **kwargs))
+
+    def try_to_cancel_previous_function(self):
+        if self.current_func_job:
+            self.current_func_job.cancel()
+        self.current_func_job = None
 
 
 app = wx.App(False)